@@ -0,0 +1,93 @@
+import asyncio
+import itertools
+import os
+
+# Lower number = served first
+PRIORITY_USER  = 0   # logged-in /chat
+PRIORITY_GUEST = 1   # anonymous /guest-chat
+
+MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))     # concurrent Gemini calls per worker
+GUEST_SHARE   = float(os.getenv("LLM_GUEST_SHARE", "0.75"))  # slots guests may hold, so users always find one
+QUEUE_WAIT    = float(os.getenv("LLM_QUEUE_WAIT", "15"))     # seconds a call may queue before it is shed
+MAX_QUEUED    = {
+    PRIORITY_USER:  int(os.getenv("LLM_MAX_QUEUED_USER", "64")),
+    PRIORITY_GUEST: int(os.getenv("LLM_MAX_QUEUED_GUEST", "16")),
+}
+
+
+class Overloaded(Exception):
+    """The call was shed: its queue was full or it waited longer than QUEUE_WAIT."""
+
+
+class Admission:
+    """
+    Priority semaphore in front of the LLM. At most `limit` calls run at
+    once, guests hold at most GUEST_SHARE of them, and queued callers are
+    admitted in (priority, arrival) order. Callers are shed with
+    Overloaded instead of queueing without bound.
+    """
+
+    def __init__(self, limit: int = MAX_IN_FLIGHT):
+        self.limit     = limit
+        self.caps      = {PRIORITY_USER: limit, PRIORITY_GUEST: max(1, int(limit * GUEST_SHARE))}
+        self.in_flight = {priority: 0 for priority in self.caps}
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []   # sorted (priority, seq, future)
+        self._seq      = itertools.count()
+        self.admitted = self.shed = 0
+
+    def _has_room(self, priority: int) -> bool:
+        return sum(self.in_flight.values()) < self.limit and self.in_flight[priority] < self.caps[priority]
+
+    def _take(self, priority: int) -> None:
+        self.in_flight[priority] += 1
+        self.admitted += 1
+
+    def _wake(self) -> None:
+        for entry in list(self._waiters):
+            priority, _, future = entry
+            if future.done():
+                self._waiters.remove(entry)
+            elif self._has_room(priority):
+                self._waiters.remove(entry)
+                self._take(priority)
+                future.set_result(None)
+            elif sum(self.in_flight.values()) >= self.limit:
+                break
+
+    async def acquire(self, priority: int) -> None:
+        ahead = any(p <= priority for p, _, _ in self._waiters)
+        if not ahead and self._has_room(priority):
+            self._take(priority)
+            return
+        if sum(1 for p, _, _ in self._waiters if p == priority) >= MAX_QUEUED[priority]:
+            self.shed += 1
+            raise Overloaded()
+
+        entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        self._waiters.sort(key=lambda e: e[:2])
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[2]), QUEUE_WAIT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+            if entry[2].done():   # admitted just as we gave up: hand the slot back
+                self.release(priority)
+            else:
+                entry[2].cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise Overloaded() from None
+            raise
+
+    def release(self, priority: int) -> None:
+        self.in_flight[priority] -= 1
+        self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": dict(self.in_flight),
+            "queued":    {p: sum(1 for q, _, _ in self._waiters if q == p) for p in self.caps},
+            "admitted":  self.admitted,
+            "shed":      self.shed,
+        }
@@ -1,71 +1,551 @@
+import asyncio
 import hashlib
-import itertools
 import os
+import re
 import time
 
-from google import genai
 from dotenv import load_dotenv
 
+from admission import Admission, Overloaded, PRIORITY_USER
+from cache import make_cache
+from key_scheduler import KeyScheduler
+from metrics import (
+    CONTEXT_CACHES, LLM_CALLS, LLM_RETRIES, LLM_SECONDS, LLM_TOKENS, PROMPT_CHARS, REPLIES,
+    note, record_stage, stage,
+)
+from rag import _NEGATIONS, _tokenise, _words, retrieve, vectorise
+from security import CHARS_PER_TOKEN, CONTEXT_CACHE
+
 load_dotenv()
 
 
 MODEL = "gemini-2.5-flash"
 
+# Seconds to wait for one Gemini call before moving on to the next key
+REQUEST_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
 
-_raw_keys = [
-    os.getenv("GEMINI_API_KEY_1") or os.getenv("GEMINI_API_KEY"),
-    os.getenv("GEMINI_API_KEY_2"),
-    os.getenv("GEMINI_API_KEY_3"),
-]
-_keys    = [k.strip() for k in _raw_keys if k and k.strip()]
-_clients = [genai.Client(api_key=k) for k in _keys]
-_pool    = itertools.cycle(_clients)
+OUTPUT_TOKENS = 512   # reply budget assumed when reserving a key's token headroom
 
-_cache: dict = {}
-CACHE_TTL = 300
 
+def _configured_keys() -> list[str]:
+    """GEMINI_API_KEYS (comma-separated), GEMINI_API_KEY and GEMINI_API_KEY_<n>, deduplicated."""
+    raw = os.getenv("GEMINI_API_KEYS", "").split(",") + [os.getenv("GEMINI_API_KEY", "")]
+    numbered = sorted(
+        (name for name in os.environ if re.fullmatch(r"GEMINI_API_KEY_\d+", name)),
+        key=lambda name: int(name.rsplit("_", 1)[1]),
+    )
+    raw += [os.environ[name] for name in numbered]
+    return list(dict.fromkeys(k.strip() for k in raw if k and k.strip()))
 
-def _cache_key(prompt: str) -> str:
-    return hashlib.md5(prompt.encode()).hexdigest()
 
+class _LazyClient:
+    """
+    A genai.Client built on first use. The google-genai SDK is heavy to
+    import, so neither it nor the clients load with the app; warm_up()
+    builds them in the background after startup instead.
+    """
 
-def ask_ai(prompt: str) -> str:
-    key = _cache_key(prompt)
-    if key in _cache:
-        result, ts = _cache[key]
-        if time.time() - ts < CACHE_TTL:
-            return result
+    __slots__ = ("_api_key", "_client")
 
-    errors = []
-    for _ in range(len(_clients)):
-        client = next(_pool)
-        try:
-            response = client.models.generate_content(model=MODEL, contents=prompt)
-            text = getattr(response, "text", None)
-            if isinstance(text, str) and text.strip():
-                _cache[key] = (text, time.time())
-                return text
-
-            if getattr(response, "candidates", None):
-                parts = []
-                for candidate in response.candidates:
-                    content = getattr(candidate, "content", None)
-                    if not content:
-                        continue
-                    for part in getattr(content, "parts", []):
-                        part_text = getattr(part, "text", None)
-                        if isinstance(part_text, str) and part_text.strip():
-                            parts.append(part_text)
-                if parts:
-                    result = "".join(parts)
-                    _cache[key] = (result, time.time())
-                    return result
+    def __init__(self, api_key: str):
+        self._api_key = api_key
+        self._client  = None
 
-        except Exception as e:
-            errors.append(str(e))
+    def build(self):
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self._api_key)
+        return self._client
+
+    @property
+    def aio(self):
+        return self.build().aio
+
+
+def warm_up() -> None:
+    """Import the SDK and build every client ahead of the first chat; safe to run in a thread."""
+    for client in _clients:
+        if isinstance(client, _LazyClient):
+            client.build()
+
+
+_keys      = _configured_keys()
+_clients   = [_LazyClient(k) for k in _keys]
+_scheduler = KeyScheduler(_clients)
+_admission = Admission()
+
+CACHE_TTL         = 300
+CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "2048"))
+CACHE_MAX_BYTES   = int(os.getenv("AI_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+_cache = make_cache(
+    "ai_responses", max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL,
+)
+
+
+def _cache_key(prompt: str, scope: str) -> str:
+    # Prompts embed personal data, so keys are scoped to the role or user
+    return hashlib.sha256(f"{scope}\0{prompt}".encode()).hexdigest()
+
+
+def key_stats() -> list[dict]:
+    return _scheduler.stats()
+
+
+def admission_stats() -> dict:
+    return _admission.stats()
+
+
+def _estimate_tokens(prompt: str) -> int:
+    return len(prompt) // CHARS_PER_TOKEN + OUTPUT_TOKENS
+
+
+def _used_tokens(response) -> int | None:
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None)
+
+
+def _record_attempt(lease, started: float, outcome: str, used: int | None = None) -> None:
+    key = lease.key.index + 1   # never the API key itself
+    LLM_SECONDS.observe(time.perf_counter() - started, key=key, outcome=outcome)
+    LLM_CALLS.inc(key=key, outcome=outcome)
+    if used:
+        LLM_TOKENS.inc(used, key=key)
+    note(key=key)
+
+
+# Answer cache keyed on (scope, data fingerprint, normalised question), so
+# "What is my attendance" and "what is my attendance?" share one reply.
+# With ANSWER_CACHE_FUZZY on, a near-identical earlier question in the same
+# bucket (TF-IDF cosine >= FUZZY_THRESHOLD) is also accepted, as long as it
+# has the same numbers, negations and short codes, and its shared terms in
+# the same order ("semester 3" is not "semester 5", "CSE to ECE" is not
+# "ECE to CSE", "RR campus" is not "EC campus").
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "1800"))
+ANSWER_FUZZY     = os.getenv("ANSWER_CACHE_FUZZY", "1") != "0"
+FUZZY_THRESHOLD  = 0.9
+BUCKET_SIZE      = 64   # recent questions per bucket considered for fuzzy matches
+
+_answers = make_cache(
+    "ai_answers", max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=ANSWER_CACHE_TTL,
+)
+
+
+def _normalise_question(question: str) -> str:
+    return " ".join(_words(question))
+
+
+def _pinned(normalised: str) -> set[str]:
+    """Words a fuzzy match must share exactly: numbers, negations and short codes."""
+    return {
+        w for w in normalised.split()
+        if w in _NEGATIONS or any(c.isdigit() for c in w) or (len(w) <= 3 and _tokenise(w))
+    }
+
+
+def _same_question(normalised: str, other: str) -> bool:
+    if _pinned(normalised) != _pinned(other):
+        return False
+    mine, theirs = _tokenise(normalised), _tokenise(other)
+    shared = set(mine) & set(theirs)
+    return [t for t in mine if t in shared] == [t for t in theirs if t in shared]
+
+
+def _answer_key(scope: str, fingerprint: str, normalised: str) -> str:
+    return hashlib.sha256(f"{scope}\0{fingerprint}\0{normalised}".encode()).hexdigest()
+
+
+def _bucket_key(scope: str, fingerprint: str) -> str:
+    return hashlib.sha256(f"bucket\0{scope}\0{fingerprint}".encode()).hexdigest()
+
+
+def lookup_answer(scope: str, fingerprint: str, question: str) -> str | None:
+    normalised = _normalise_question(question)
+    if not normalised:
+        return None
+    answer = _answers.get(_answer_key(scope, fingerprint, normalised))
+    if answer is not None or not ANSWER_FUZZY:
+        return answer
+
+    q_vec = vectorise(normalised)
+    best, best_score = None, FUZZY_THRESHOLD
+    for other in _answers.get(_bucket_key(scope, fingerprint)) or []:
+        o_vec = vectorise(other)
+        score = sum(w * o_vec.get(t, 0.0) for t, w in q_vec.items())
+        if score >= best_score and _same_question(normalised, other):
+            best, best_score = other, score
+    return _answers.get(_answer_key(scope, fingerprint, best)) if best else None
+
+
+def _remember(key: str, reply: str, scope: str, question: str | None, fingerprint: str) -> None:
+    _cache.set(key, reply)
+    if question is None:
+        return
+    normalised = _normalise_question(question)
+    if not normalised:
+        return
+    _answers.set(_answer_key(scope, fingerprint, normalised), reply)
+    if ANSWER_FUZZY:
+        bucket = _bucket_key(scope, fingerprint)
+        recent = [q for q in _answers.get(bucket) or [] if q != normalised]
+        _answers.set(bucket, [normalised] + recent[: BUCKET_SIZE - 1])
+
+
+# ── Context caches ─────────────────────────────────────────────────────────────
+# The "prefix" of a build_ai_context() prompt (persona, rules and the whole
+# knowledge base) is stored once per API key as a Gemini context cache, and
+# calls on that key send only the prompt's "rest" against it. A cache is
+# created in the background the first time its prefix is seen on a key, its
+# TTL is pushed out while it is in use, and a key whose cache cannot be
+# created retries after CONTEXT_CACHE_RETRY seconds. Until a key's cache is
+# live its calls send the prompt's "text", which carries retrieved chunks
+# instead of the whole knowledge base.
+CONTEXT_CACHE_TTL        = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))   # API minimum for the model
+CONTEXT_CACHE_RETRY      = 600
+
+# (key index, prefix digest) -> {"name": cache name or None, "expires": float, "retry_at": float, "busy": bool}
+_context_caches: dict[tuple[int, str], dict] = {}
+_background: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def _context_slot(lease, prefix: str) -> dict:
+    slot = (lease.key.index, hashlib.sha256(prefix.encode()).hexdigest()[:16])
+    return _context_caches.setdefault(slot, {"name": None, "expires": 0.0, "retry_at": 0.0, "busy": False})
+
+
+def _context_cache(lease, prefix: str) -> str | None:
+    """Name of a live context cache holding `prefix` on the lease's key, or None to send the prompt inline."""
+    if not CONTEXT_CACHE or not prefix or len(prefix) // CHARS_PER_TOKEN < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    entry = _context_slot(lease, prefix)
+    now   = time.time()
+    live  = entry["name"] is not None and now < entry["expires"] - REQUEST_TIMEOUT   # outlives this call
+    # busy is set here, not in the task: calls in the same loop tick must not each start one
+    if not entry["busy"]:
+        if not live and now >= entry["retry_at"]:
+            entry["busy"] = True
+            _spawn(_create_context_cache(lease.client, lease.key.index, entry, prefix))
+        elif live and entry["expires"] - now < CONTEXT_CACHE_TTL / 2:
+            entry["busy"] = True
+            _spawn(_refresh_context_cache(lease.client, lease.key.index, entry))
+    CONTEXT_CACHES.inc(result="hit" if live else "inline")
+    return entry["name"] if live else None
+
+
+async def _create_context_cache(client, index: int, entry: dict, prefix: str) -> None:
+    started = time.time()
+    try:
+        cache = await asyncio.wait_for(
+            client.aio.caches.create(model=MODEL, config={
+                "contents": [prefix], "ttl": f"{CONTEXT_CACHE_TTL}s", "display_name": "pesu-prompt-prefix",
+            }),
+            timeout=REQUEST_TIMEOUT,
+        )
+        entry["name"], entry["expires"] = cache.name, started + CONTEXT_CACHE_TTL
+        CONTEXT_CACHES.inc(result="created")
+    except Exception as e:
+        entry["name"], entry["retry_at"] = None, time.time() + CONTEXT_CACHE_RETRY
+        CONTEXT_CACHES.inc(result="failed")
+        print(f"[AI] Context cache unavailable on key {index + 1}, sending prompts inline: {e}")
+    finally:
+        entry["busy"] = False
+
+
+async def _refresh_context_cache(client, index: int, entry: dict) -> None:
+    started = time.time()
+    try:
+        await asyncio.wait_for(
+            client.aio.caches.update(name=entry["name"], config={"ttl": f"{CONTEXT_CACHE_TTL}s"}),
+            timeout=REQUEST_TIMEOUT,
+        )
+        entry["expires"] = started + CONTEXT_CACHE_TTL
+        CONTEXT_CACHES.inc(result="refreshed")
+    except Exception as e:
+        entry["name"] = None   # recreated on its next use
+        print(f"[AI] Context cache refresh failed on key {index + 1}: {e}")
+    finally:
+        entry["busy"] = False
+
+
+def _drop_context_cache(lease, prefix: str) -> None:
+    """Forget a cache a call failed against (expired or deleted upstream); the next use recreates it."""
+    _context_slot(lease, prefix)["name"] = None
+    CONTEXT_CACHES.inc(result="dropped")
+
+
+def _as_prompt(prompt: dict | str) -> dict:
+    """A build_ai_context() result as is; a plain string as a prompt that is never cached."""
+    return prompt if isinstance(prompt, dict) else {"text": prompt, "prefix": "", "rest": ""}
+
+
+def _request(lease, prompt: dict) -> tuple[str, dict | None, bool]:
+    """(contents, config, uses a context cache) for one attempt on `lease`."""
+    name = _context_cache(lease, prompt["prefix"])
+    if name:
+        return prompt["rest"], {"cached_content": name}, True
+    return prompt["text"], None, False
+
+
+async def close_context_caches() -> None:
+    """Delete this worker's context caches so they stop accruing storage."""
+    for (index, _), entry in list(_context_caches.items()):
+        if entry["name"]:
+            try:
+                await _clients[index].aio.caches.delete(name=entry["name"])
+            except Exception as e:
+                print(f"[AI] Could not delete context cache on key {index + 1}: {e}")
+    _context_caches.clear()
+
+
+def _extract_text(response) -> str | None:
+    text = getattr(response, "text", None)
+    if isinstance(text, str) and text.strip():
+        return text
+
+    parts = []
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        if not content:
             continue
+        for part in getattr(content, "parts", None) or []:
+            part_text = getattr(part, "text", None)
+            if isinstance(part_text, str) and part_text.strip():
+                parts.append(part_text)
+    return "".join(parts) or None
+
+
+async def ask_ai(
+    prompt: dict | str, scope: str = "", question: str | None = None, fingerprint: str = "",
+    priority: int = PRIORITY_USER, on_answer=None,
+) -> str:
+    """
+    Generate a reply on the SDK's async client so the event loop keeps
+    serving other users while Gemini works. The key scheduler picks the
+    key with the most headroom; each key gets REQUEST_TIMEOUT seconds
+    before the next one is tried. `scope` (role or role:username)
+    keeps cached replies from being shared across users; passing the raw
+    `question` and a `fingerprint` of the user's data enables the answer cache.
+    Cache misses queue for an admission slot by `priority`; if they are
+    shed, the closest knowledge passage is returned instead. `prompt` is
+    a build_ai_context() result: its cached form is sent on keys whose
+    context cache is live, its "text" everywhere else. `on_answer(reply)`
+    is called for a model answer, fresh or cached, but not for a busy or
+    error reply.
+    """
+    prompt = _as_prompt(prompt)
+    if question is not None:
+        answer = lookup_answer(scope, fingerprint, question)
+        if answer is not None:
+            REPLIES.inc(source="answer_cache")
+            if on_answer:
+                on_answer(answer)
+            return answer
+
+    key    = _cache_key(prompt["text"], scope)
+    cached = _cache.get(key)
+    if cached is not None:
+        REPLIES.inc(source="response_cache")
+        if on_answer:
+            on_answer(cached)
+        return cached
 
+    try:
+        await _admission.acquire(priority)
+    except Overloaded:
+        REPLIES.inc(source="shed")
+        return _busy_reply(question)
+    try:
+        return await _generate(prompt, key, scope, question, fingerprint, on_answer)
+    finally:
+        _admission.release(priority)
+
+
+def _start_attempt(tried: set, contents: str) -> None:
+    if tried:
+        LLM_RETRIES.inc()
+    note(retries=len(tried), prompt_chars=len(contents))
+
+
+async def _generate(prompt: dict, key: str, scope: str, question: str | None, fingerprint: str, on_answer) -> str:
+    errors, tried = [], set()
+    tokens = _estimate_tokens(prompt["text"])
+    inline_retry = False
+    with stage("llm"):
+        while len(tried) < len(_scheduler):
+            with stage("key_wait"):
+                lease = await _scheduler.acquire(tokens, exclude=tried)
+            if lease is None:
+                errors.append("rate limit: no API key has headroom")
+                break
+            contents, config, cached = _request(lease, prompt)
+            _start_attempt(tried, contents)
+            PROMPT_CHARS.observe(len(contents))
+            tried.add(lease.key.index)
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    lease.client.aio.models.generate_content(model=MODEL, contents=contents, config=config),
+                    timeout=REQUEST_TIMEOUT,
+                )
+                used = _used_tokens(response)
+                lease.ok(used)
+                text = _extract_text(response)
+                _record_attempt(lease, started, "ok" if text else "empty", used)
+                if text:
+                    _remember(key, text, scope, question, fingerprint)
+                    REPLIES.inc(source="llm")
+                    if on_answer:
+                        on_answer(text)
+                    return text
+
+            except asyncio.TimeoutError as e:
+                lease.failed(e)
+                _record_attempt(lease, started, "timeout")
+                errors.append(f"Request timed out after {REQUEST_TIMEOUT:g}s")
+                continue
+            except Exception as e:
+                lease.failed(e)
+                _record_attempt(lease, started, "error")
+                errors.append(str(e))
+                if cached and not inline_retry:   # give the key one more go without the cache
+                    _drop_context_cache(lease, prompt["prefix"])
+                    tried.discard(lease.key.index)
+                    inline_retry = True
+                continue
+
+    REPLIES.inc(source="error")
+    return _error_reply(errors)
+
+
+def _busy_reply(question: str | None) -> str:
+    """Degraded reply for a shed call: the closest knowledge passage, if any."""
+    passage = retrieve(question, top_k=1) if question else ""
+    if passage:
+        return (
+            "I'm handling a lot of questions right now, so here is the most relevant "
+            f"part of the PESU handbook:\n\n{passage}"
+        )
+    return "I'm handling a lot of questions right now. Please try again in a moment."
+
+
+def _error_reply(errors: list[str]) -> str:
     err = " | ".join(errors) if errors else "Unknown error"
     if any("quota" in e.lower() or "429" in e or "rate" in e.lower() for e in errors):
         return "All API keys have hit their rate limit. Please wait a minute and try again."
-    return f"AI error: {err}"
\ No newline at end of file
+    return f"AI error: {err}"
+
+
+async def stream_ai(
+    prompt: dict | str, scope: str = "", question: str | None = None, fingerprint: str = "",
+    priority: int = PRIORITY_USER, on_answer=None,
+):
+    """
+    Async generator yielding reply text as Gemini produces it. Keys are
+    switched only until the first chunk arrives; REQUEST_TIMEOUT bounds the
+    wait for each chunk. The full reply is cached, and passed to
+    `on_answer`, once the stream ends. Admission works as in ask_ai();
+    the slot is held for the whole stream.
+    """
+    prompt = _as_prompt(prompt)
+    if question is not None:
+        answer = lookup_answer(scope, fingerprint, question)
+        if answer is not None:
+            REPLIES.inc(source="answer_cache")
+            if on_answer:
+                on_answer(answer)
+            yield answer
+            return
+
+    key    = _cache_key(prompt["text"], scope)
+    cached = _cache.get(key)
+    if cached is not None:
+        REPLIES.inc(source="response_cache")
+        if on_answer:
+            on_answer(cached)
+        yield cached
+        return
+
+    try:
+        await _admission.acquire(priority)
+    except Overloaded:
+        REPLIES.inc(source="shed")
+        yield _busy_reply(question)
+        return
+    try:
+        async for text in _generate_stream(prompt, key, scope, question, fingerprint, on_answer):
+            yield text
+    finally:
+        _admission.release(priority)
+
+
+async def _generate_stream(prompt: dict, key: str, scope: str, question: str | None, fingerprint: str, on_answer):
+    errors, tried = [], set()
+    tokens = _estimate_tokens(prompt["text"])
+    inline_retry = False
+    began = time.perf_counter()
+    while len(tried) < len(_scheduler):
+        with stage("key_wait"):
+            lease = await _scheduler.acquire(tokens, exclude=tried)
+        if lease is None:
+            errors.append("rate limit: no API key has headroom")
+            break
+        contents, config, cached = _request(lease, prompt)
+        _start_attempt(tried, contents)
+        PROMPT_CHARS.observe(len(contents))
+        tried.add(lease.key.index)
+        parts, used = [], None
+        started = time.perf_counter()
+        try:
+            stream = await asyncio.wait_for(
+                lease.client.aio.models.generate_content_stream(model=MODEL, contents=contents, config=config),
+                timeout=REQUEST_TIMEOUT,
+            )
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), timeout=REQUEST_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                used = _used_tokens(chunk) or used   # the last chunk carries the totals
+                text = getattr(chunk, "text", None)
+                if isinstance(text, str) and text:
+                    if not parts:
+                        record_stage("llm_first_token", time.perf_counter() - began)
+                    parts.append(text)
+                    yield text
+            lease.ok(used)
+            _record_attempt(lease, started, "ok" if parts else "empty", used)
+
+        except Exception as e:
+            lease.failed(e)
+            _record_attempt(lease, started, "timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+            if parts:   # already streamed to the user, cannot switch keys
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                errors.append(f"Request timed out after {REQUEST_TIMEOUT:g}s")
+            else:
+                errors.append(str(e))
+                if cached and not inline_retry:   # give the key one more go without the cache
+                    _drop_context_cache(lease, prompt["prefix"])
+                    tried.discard(lease.key.index)
+                    inline_retry = True
+            continue
+
+        result = "".join(parts)
+        if result.strip():
+            _remember(key, result, scope, question, fingerprint)
+            record_stage("llm", time.perf_counter() - began)
+            REPLIES.inc(source="llm")
+            if on_answer:
+                on_answer(result)
+            return
+
+    record_stage("llm", time.perf_counter() - began)
+    REPLIES.inc(source="error")
+    yield _error_reply(errors)
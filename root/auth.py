@@ -1,22 +1,68 @@
+import base64
+import hashlib
+import hmac
+import os
 import uuid
-from datetime import datetime, timedelta
-active_sessions={}
+from cryptography.fernet import Fernet, InvalidToken
+from cache import CACHE_BACKEND, make_cache
+import conversation
+SESSION_TTL=2*3600
+# Portal passwords are stored encrypted, so the shared SQLite store never
+# holds them in the clear. Workers sharing that store must share
+# SESSION_SECRET; without it each worker makes its own key and can only
+# read the sessions it created.
+_secret=os.getenv("SESSION_SECRET","")
+if not _secret and CACHE_BACKEND=="sqlite":
+    print("[AUTH] SESSION_SECRET is not set; sessions will only be readable by the worker that created them")
+_key=hashlib.sha256(_secret.encode()).digest() if _secret else os.urandom(32)
+_fernet=Fernet(base64.urlsafe_b64encode(_key))
+# token -> {"username", "secret": encrypted password, "credential", "role"}; expiry is the store's TTL
+active_sessions=make_cache(
+    "sessions",
+    max_entries=int(os.getenv("SESSION_MAX_ENTRIES","50000")),
+    max_bytes=64*1024*1024,
+    ttl=SESSION_TTL,
+)
+# token -> conversation.new() history of the session's /chat messages
+conversations=make_cache(
+    "conversations",
+    max_entries=int(os.getenv("SESSION_MAX_ENTRIES","50000")),
+    max_bytes=128*1024*1024,
+    ttl=SESSION_TTL,
+)
+def _credential(username,password):
+    # tells logins with the same credentials apart without storing anything reversible
+    return hmac.new(_key,f"{username}\0{password}".encode(),hashlib.sha256).hexdigest()
+def _open(record):
+    try:
+        password=_fernet.decrypt(record["secret"]).decode()
+    except (InvalidToken,KeyError):
+        return None
+    return {"username":record["username"],"password":password,"role":record["role"]}
 def create_session(username,password,role):
     token= str(uuid.uuid4())
-    active_sessions[token]={
+    active_sessions.set(token,{
         "username": username,
-        "password":password,
+        "secret":_fernet.encrypt(password.encode()),
+        "credential":_credential(username,password),
         "role":role,
-        "expires_at":datetime.now()+ timedelta(hours=2)
-        }
+        })
     return token
 def get_session(token):
-    session=active_sessions.get(token)
-    if not session:
-        return None
-    if datetime.now() > session["expires_at"]:
-        del active_sessions[token]
-        return None
-    return session
+    record=active_sessions.get(token)
+    return _open(record) if record else None
+def live_sessions():
+    # (token, {"username", "password", "role"}) for every session this worker can read
+    sessions=((token,_open(record)) for token,record in active_sessions.items())
+    return [(token,session) for token,session in sessions if session]
 def delete_session(token):
-    active_sessions.pop(token,None)
\ No newline at end of file
+    active_sessions.delete(token)
+    conversations.delete(token)
+def credentials_in_use(username,password):
+    # a student and their parent log in with the same SRN and password
+    credential=_credential(username,password)
+    return any(record.get("credential")==credential for _,record in active_sessions.items())
+def get_conversation(token):
+    return conversations.get(token) or conversation.new()
+def save_turn(token,question,reply):
+    conversations.set(token,conversation.add_turn(get_conversation(token),question,reply))
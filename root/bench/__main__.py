@@ -0,0 +1,79 @@
+"""
+Offline benchmarks, run from root/:
+
+    python -m bench micro --scale medium
+    python -m bench load --scenario chat --requests 500 --concurrency 50
+    python -m bench startup --budget 1.0
+
+Nothing here talks to the real portal or Gemini: `load` swaps in the
+stand-ins from bench.fakes and drives the app in-process over ASGI.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def main(argv: list[str] | None = None) -> None:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", help="also write the results to this file")
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    sub    = parser.add_subparsers(dest="mode", required=True)
+
+    micro = sub.add_parser("micro", parents=[common],
+                           help="time the hot paths (RAG, role filtering, context, encoding)")
+    micro.add_argument("--scale", choices=["small", "medium", "large"], default="small")
+    micro.add_argument("--repeat", type=int, default=200)
+
+    load = sub.add_parser("load", parents=[common],
+                          help="concurrent requests against the app with fake upstreams")
+    load.add_argument("--scenario", action="append", choices=["login", "me", "chat", "guest-chat"],
+                      help="repeatable; defaults to all")
+    load.add_argument("--scale", choices=["small", "medium", "large"], default="medium")
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--concurrency", type=int, default=20)
+    load.add_argument("--portal-latency", type=float, default=0.05, help="seconds per portal call")
+    load.add_argument("--portal-errors", type=float, default=0.0, help="failure probability per portal call")
+    load.add_argument("--llm-latency", type=float, default=0.8, help="seconds per Gemini reply")
+    load.add_argument("--llm-errors", type=float, default=0.0, help="429 probability per Gemini call")
+    load.add_argument("--keys", type=int, default=3, help="number of fake API keys")
+    load.add_argument("--unique", action="store_true", help="distinct users / questions to defeat caches")
+
+    startup = sub.add_parser("startup", parents=[common],
+                             help="import time and time to ready; fails over --budget")
+    startup.add_argument("--budget", type=float, default=1.0, help="seconds allowed for `import main`")
+    startup.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args(argv)
+
+    # the app resolves knowledge/ and frontend/ relative to the working directory
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+
+    ok = True
+    if args.mode == "micro":
+        from bench import micro as bench_micro
+        rows = bench_micro.run(args.scale, args.repeat)
+    elif args.mode == "startup":
+        from bench import startup as bench_startup
+        rows, ok = bench_startup.run(args.budget, args.repeat)
+    else:
+        from bench import load as bench_load
+        rows = asyncio.run(bench_load.run(
+            args.scenario or bench_load.SCENARIOS, args.requests, args.concurrency, args.scale,
+            args.portal_latency, args.portal_errors, args.llm_latency, args.llm_errors,
+            args.keys, args.unique,
+        ))
+
+    if args.json:
+        from bench.report import write_json
+        write_json(rows, args.json)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import random
+import zlib
+from pathlib import Path
+
+# scale -> (knowledge files, words per file)
+KNOWLEDGE_SCALES = {"small": (8, 300), "medium": (100, 1000), "large": (1000, 2000)}
+# scale -> (semesters, courses per semester)
+DATA_SCALES      = {"small": (2, 6), "medium": (6, 8), "large": (8, 12)}
+
+DAYS  = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
+TIMES = ["08:15", "09:10", "10:05", "11:15", "12:10", "14:00", "14:55", "15:50"]
+
+_TOPICS = [
+    "attendance", "hostel", "curfew", "exam", "scholarship", "placement", "library",
+    "fees", "canteen", "transport", "club", "fest", "internship", "project", "grading",
+    "condonation", "malpractice", "laboratory", "elective", "mentor", "semester", "backlog",
+]
+_FILLER = (
+    "students faculty university campus department policy rule must should may required "
+    "allowed permission approval office portal deadline week month term percent minimum "
+    "maximum submit apply contact during after before within each every annual review"
+).split()
+
+
+def _rng(*seed) -> random.Random:
+    return random.Random(zlib.crc32(repr(seed).encode()))
+
+
+def make_attendance(username: str, semesters: int, courses: int) -> dict:
+    """{"<sem>": [course dict, ...]} shaped like the portal's serialised attendance."""
+    rng  = _rng("attendance", username)
+    data = {}
+    for sem in range(1, semesters + 1):
+        rows = []
+        for i in range(courses):
+            total    = rng.randint(20, 45)
+            attended = rng.randint(total // 2, total)
+            rows.append({
+                "code":       f"UE{22 + sem // 3}CS{sem}{i:02d}A",
+                "title":      f"{rng.choice(_TOPICS).title()} {rng.choice(_FILLER).title()} {i + 1}",
+                "type":       "Core" if i % 3 else "Elective",
+                "status":     "active" if sem == semesters else "completed",
+                "attendance": {"attended": attended, "total": total,
+                               "percentage": round(100 * attended / total, 2)},
+                "id":         f"{sem}-{i}",
+            })
+        data[str(sem)] = rows
+    return data
+
+
+def make_timetable(courses: int) -> dict:
+    rng = _rng("timetable", courses)
+    return {"schedule": {
+        day: [
+            {"time": t, "course": f"UE23CS{rng.randint(1, courses):02d}A",
+             "room": f"{rng.choice('ABCDF')}{rng.randint(101, 510)}"}
+            for t in TIMES[: rng.randint(4, len(TIMES))]
+        ]
+        for day in DAYS
+    }}
+
+
+def make_profile(username: str) -> dict:
+    rng = _rng("profile", username)
+    return {
+        "name":     f"Student {username}",
+        "srn":      username,
+        "program":  "B.Tech",
+        "branch":   "Computer Science and Engineering",
+        "semester": 6,
+        "section":  rng.choice("ABCDEFGH"),
+        "email":    f"{username.lower()}@pesu.pes.edu",
+        "address":  "Synthetic Address, Bengaluru",
+        "parents":  {"father": "Synthetic Parent", "phone": "0000000000"},
+    }
+
+
+def make_raw_data(username: str = "PES1UG23CS001", scale: str = "medium") -> dict:
+    """The dict data_fetcher assembles for a student, at a DATA_SCALES size."""
+    semesters, courses = DATA_SCALES[scale]
+    return {
+        "username":   username,
+        "attendance": make_attendance(username, semesters, courses),
+        "timetable":  make_timetable(courses),
+        "profile":    make_profile(username),
+        "version":    1,
+    }
+
+
+def write_knowledge(directory: Path, scale: str = "small") -> Path:
+    """Write a synthetic knowledge/ corpus of headed, sentence-structured .txt files."""
+    files, words_per_file = KNOWLEDGE_SCALES[scale]
+    directory.mkdir(parents=True, exist_ok=True)
+    for n in range(files):
+        rng   = _rng("knowledge", n)
+        topic = _TOPICS[n % len(_TOPICS)]
+        lines, words = [f"{topic.title()} Guidelines {n}"], 0
+        while words < words_per_file:
+            if rng.random() < 0.1:
+                lines.append(f"{rng.choice(_TOPICS).title()} {rng.choice(_FILLER).title()}")
+            length   = rng.randint(8, 22)
+            sentence = [rng.choice(_FILLER if rng.random() < 0.7 else _TOPICS) for _ in range(length)]
+            sentence[0] = topic
+            lines.append(" ".join(sentence).capitalize() + f" within {rng.randint(1, 30)} days.")
+            words += length + 3
+        (directory / f"{topic}_{n:04d}.txt").write_text("\n".join(lines), encoding="utf-8")
+    return directory
+
+
+QUESTIONS = [
+    "What is the minimum attendance required?",
+    "Which of my courses are below 75%?",
+    "What is the hostel curfew?",
+    "How do I apply for a scholarship?",
+    "When is my next class on Monday?",
+    "Can I skip classes tomorrow?",
+    "What are the rules about malpractice in exams?",
+    "How is condonation approved?",
+    "Tell me about the placement policy",
+    "Show my attendance",
+]
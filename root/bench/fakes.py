@@ -0,0 +1,228 @@
+import asyncio
+import random
+import time
+import types
+
+from bench.corpus import make_attendance, make_profile, make_timetable
+
+
+def _jitter(latency: float) -> float:
+    return latency * random.uniform(0.5, 1.5) if latency > 0 else 0.0
+
+
+class _Model:
+    """Stand-in for the pesuacademy pydantic models: only model_dump() is used."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def model_dump(self, mode: str = "python"):
+        return self._data
+
+
+class FakePESUAcademy:
+    """
+    Drop-in for pesuacademy.PESUAcademy. Every call sleeps for about
+    `latency` seconds and fails with probability `error_rate`; the data
+    comes from bench.corpus at the configured scale.
+    """
+
+    latency    = 0.05
+    error_rate = 0.0
+    semesters  = 6
+    courses    = 8
+    logins     = 0
+    calls      = 0
+
+    @classmethod
+    def configure(cls, latency: float = 0.05, error_rate: float = 0.0, semesters: int = 6, courses: int = 8):
+        cls.latency, cls.error_rate = latency, error_rate
+        cls.semesters, cls.courses  = semesters, courses
+        cls.logins = cls.calls = 0
+
+    def __init__(self, username: str = ""):
+        self.username = username
+
+    @classmethod
+    async def _call(cls) -> None:
+        cls.calls += 1
+        await asyncio.sleep(_jitter(cls.latency))
+        if random.random() < cls.error_rate:
+            raise ConnectionError("Fake portal connection reset")
+
+    @classmethod
+    async def login(cls, username: str, password: str):
+        cls.logins += 1
+        await cls._call()
+        await cls._call()   # the real login is a CSRF fetch plus the POST
+        if password == "wrong":
+            raise Exception("Invalid credentials")
+        return cls(username)
+
+    async def get_attendance(self, semester: int | None = None):
+        await self._call()
+        data = make_attendance(self.username, self.semesters, self.courses)
+        if semester:
+            return {semester: [_Model(c) for c in data.get(str(semester), [])]}
+        return {int(sem): [_Model(c) for c in courses] for sem, courses in data.items()}
+
+    async def get_timetable(self):
+        await self._call()
+        return _Model(make_timetable(self.courses))
+
+    async def get_profile(self):
+        await self._call()
+        return _Model(make_profile(self.username))
+
+    async def get_section_info(self, section: str):
+        await self._call()
+        return _Model({"section": section, "students": 64})
+
+    async def close(self):
+        pass
+
+
+class FakeRateLimit(Exception):
+    """Shaped like google.genai.errors.ClientError for a 429."""
+
+    code = 429
+
+    def __init__(self, delay: float):
+        super().__init__(
+            "429 RESOURCE_EXHAUSTED. {'error': {'code': 429, 'details': "
+            f"[{{'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '{delay:g}s'}}]}}}}"
+        )
+
+
+class FakeNotFound(Exception):
+    """Shaped like google.genai.errors.ClientError for a 404."""
+
+    code = 404
+
+
+class _FakeCaches:
+    """client.aio.caches: explicit context caches held in memory with their TTL."""
+
+    min_tokens = 1024
+
+    def __init__(self):
+        self.store: dict[str, tuple[str, float]] = {}   # name -> (contents, expires_at)
+        self.created = self.updated = self.deleted = 0
+
+    @staticmethod
+    def _ttl(config: dict) -> float:
+        return float(config["ttl"].rstrip("s"))
+
+    async def create(self, model: str, config: dict):
+        contents = "".join(str(c) for c in config["contents"])
+        if len(contents) // 4 < self.min_tokens:
+            raise Exception(f"400 INVALID_ARGUMENT. Cached content is too small, min_total_token_count={self.min_tokens}")
+        self.created += 1
+        name = f"cachedContents/fake-{self.created}"
+        self.store[name] = (contents, time.monotonic() + self._ttl(config))
+        return types.SimpleNamespace(name=name)
+
+    async def update(self, name: str, config: dict):
+        contents, _ = self.lookup(name)
+        self.updated += 1
+        self.store[name] = (contents, time.monotonic() + self._ttl(config))
+        return types.SimpleNamespace(name=name)
+
+    async def delete(self, name: str):
+        self.deleted += 1
+        self.store.pop(name, None)
+
+    def lookup(self, name: str) -> tuple[str, float]:
+        entry = self.store.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            self.store.pop(name, None)
+            raise FakeNotFound(f"404 NOT_FOUND. CachedContent {name} not found")
+        return entry
+
+
+class _FakeModels:
+    def __init__(self, owner: "FakeGemini"):
+        self._owner = owner
+
+    def _contents(self, contents, config) -> tuple[str, int]:
+        """(full prompt, cached characters) of a call, resolving a cached_content prefix."""
+        name = (config or {}).get("cached_content")
+        if not name:
+            return str(contents), 0
+        prefix, _ = self._owner.caches.lookup(name)
+        self._owner.cached_calls += 1
+        return prefix + str(contents), len(prefix)
+
+    async def generate_content(self, model: str, contents, config=None, **kwargs):
+        contents, cached = self._contents(contents, config)
+        text = await self._owner._reply(contents)
+        return types.SimpleNamespace(text=text, usage_metadata=self._owner._usage(contents, text, cached))
+
+    async def generate_content_stream(self, model: str, contents, config=None, **kwargs):
+        contents, cached = self._contents(contents, config)
+        text  = await self._owner._reply(contents, first_token=True)
+        words = text.split(" ")
+        owner = self._owner
+
+        async def stream():
+            for i in range(0, len(words), 8):
+                await asyncio.sleep(_jitter(owner.token_latency))
+                last = i + 8 >= len(words)
+                yield types.SimpleNamespace(
+                    text=" ".join(words[i : i + 8]) + ("" if last else " "),
+                    usage_metadata=owner._usage(contents, text, cached) if last else None,
+                )
+        return stream()
+
+
+class FakeGemini:
+    """
+    Drop-in for genai.Client: `client.aio.models.generate_content(_stream)`
+    and `client.aio.caches`. Replies take about `latency` seconds (time to
+    first token when streaming) and fail with a 429 with probability
+    `error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.8, error_rate: float = 0.0, token_latency: float = 0.02):
+        self.latency       = latency
+        self.error_rate    = error_rate
+        self.token_latency = token_latency
+        self.calls         = 0
+        self.cached_calls  = 0
+        self.caches        = _FakeCaches()
+        self.aio           = types.SimpleNamespace(models=_FakeModels(self), caches=self.caches)
+
+    async def _reply(self, contents, first_token: bool = False) -> str:
+        self.calls += 1
+        await asyncio.sleep(_jitter(self.latency))
+        if random.random() < self.error_rate:
+            raise FakeRateLimit(delay=1)
+        prompt = str(contents)
+        return f"Here is what I found ({len(prompt)} prompt chars). " + "This is a synthetic answer. " * 12
+
+    def _usage(self, contents, text: str, cached_chars: int = 0):
+        prompt_tokens = len(str(contents)) // 4
+        return types.SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_chars // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+
+
+def install(portal_latency: float = 0.05, portal_errors: float = 0.0, llm_latency: float = 0.8,
+            llm_errors: float = 0.0, keys: int = 3, semesters: int = 6, courses: int = 8) -> list[FakeGemini]:
+    """Swap the portal and Gemini clients of the imported app for fakes."""
+    import ai_handler
+    import data_fetcher
+    import key_scheduler
+
+    FakePESUAcademy.configure(portal_latency, portal_errors, semesters, courses)
+    data_fetcher.PESUAcademy = FakePESUAcademy
+
+    # budgets high enough that the scheduler itself is not what is measured
+    key_scheduler.KEY_RPM, key_scheduler.KEY_TPM, key_scheduler.KEY_RPD = 10**6, 10**9, 10**7
+    clients = [FakeGemini(llm_latency, llm_errors) for _ in range(keys)]
+    ai_handler._clients   = clients
+    ai_handler._scheduler = key_scheduler.KeyScheduler(clients)
+    ai_handler._context_caches.clear()
+    return clients
@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+import time
+
+import httpx
+
+from bench import fakes
+from bench.corpus import DATA_SCALES, QUESTIONS
+from bench.report import print_row, summarise
+
+SCENARIOS = ["login", "me", "chat", "guest-chat"]
+
+
+async def _login(client: httpx.AsyncClient, username: str) -> str:
+    r = await client.post("/login", json={"username": username, "password": "bench"})
+    r.raise_for_status()
+    return r.json()["token"]
+
+
+async def _drive(name: str, requests: int, concurrency: int, call) -> dict:
+    """Fire `requests` calls of `call(i)` with at most `concurrency` in flight."""
+    gate    = asyncio.Semaphore(concurrency)
+    samples = []
+    errors  = 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with gate:
+            start = time.perf_counter()
+            try:
+                r = await call(i)
+                if r.status_code >= 400:
+                    errors += 1
+                    return
+            except Exception:
+                errors += 1
+                return
+            samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    row = summarise(name, samples, elapsed=time.perf_counter() - start, errors=errors)
+    print_row(row)
+    return row
+
+
+async def _scenario(client: httpx.AsyncClient, name: str, requests: int, concurrency: int, unique: bool) -> dict:
+    # `unique` gives every request its own user / question so no cache can answer it
+    if name == "login":
+        return await _drive(name, requests, concurrency, lambda i: client.post(
+            "/login", json={"username": f"PES1UG23CS{i if unique else 0:05d}", "password": "bench"},
+        ))
+
+    if name == "me":
+        users  = requests if unique else 1
+        tokens = [await _login(client, f"PES1UG23CS{n:05d}") for n in range(min(users, concurrency * 4))]
+        return await _drive(name, requests, concurrency, lambda i: client.get(
+            "/me", params={"token": tokens[i % len(tokens)]},
+        ))
+
+    questions = itertools.cycle(QUESTIONS)
+
+    def question(i: int) -> str:
+        q = next(questions)
+        return f"{q} (#{i})" if unique else q
+
+    if name == "chat":
+        token = await _login(client, "PES1UG23CS00000")
+        return await _drive(name, requests, concurrency, lambda i: client.post(
+            "/chat", json={"token": token, "message": question(i)},
+        ))
+
+    if name == "guest-chat":
+        return await _drive(name, requests, concurrency, lambda i: client.post(
+            "/guest-chat", json={"message": question(i)},
+        ))
+
+    raise ValueError(f"Unknown scenario {name!r}; expected one of {SCENARIOS}")
+
+
+async def run(scenarios: list[str], requests: int = 200, concurrency: int = 20, scale: str = "medium",
+              portal_latency: float = 0.05, portal_errors: float = 0.0, llm_latency: float = 0.8,
+              llm_errors: float = 0.0, keys: int = 3, unique: bool = False) -> list[dict]:
+    """Load-test the ASGI app in-process against the fake portal and Gemini."""
+    import main
+
+    semesters, courses = DATA_SCALES[scale]
+    clients = fakes.install(portal_latency, portal_errors, llm_latency, llm_errors, keys, semesters, courses)
+
+    await main.startup()
+    rows = []
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            for name in scenarios:
+                rows.append(await _scenario(client, name, requests, concurrency, unique))
+    finally:
+        await main.shutdown()
+
+    print(f"[BENCH] Portal logins={fakes.FakePESUAcademy.logins} calls={fakes.FakePESUAcademy.calls}  "
+          f"LLM calls={sum(c.calls for c in clients)} (with context cache {sum(c.cached_calls for c in clients)})")
+    return rows
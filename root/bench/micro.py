@@ -0,0 +1,70 @@
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import payload
+import rag
+from bench.corpus import QUESTIONS, make_raw_data, write_knowledge
+from bench.report import print_row, summarise
+from security import build_ai_context, filter_data_for_role, prepare_context
+
+
+def _time(name: str, fn, repeat: int) -> dict:
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    row = summarise(name, samples)
+    print_row(row)
+    return row
+
+
+@contextmanager
+def _knowledge_at(directory: Path):
+    """Point rag at another knowledge/ directory for the duration."""
+    saved = rag.KNOWLEDGE_DIR, rag.INDEX_DIR, rag.INDEX_PATH, rag.SEGMENT_DIR
+    rag.KNOWLEDGE_DIR = directory
+    rag.INDEX_DIR     = directory / ".index"
+    rag.INDEX_PATH    = rag.INDEX_DIR / "rag.idx"
+    rag.SEGMENT_DIR   = rag.INDEX_DIR / "segments"
+    try:
+        yield
+    finally:
+        rag.KNOWLEDGE_DIR, rag.INDEX_DIR, rag.INDEX_PATH, rag.SEGMENT_DIR = saved
+        rag.load_knowledge()
+
+
+def run(scale: str = "small", repeat: int = 200) -> list[dict]:
+    """Microbenchmarks of the per-request hot paths on synthetic data of one scale."""
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp, _knowledge_at(Path(tmp) / "knowledge"):
+        write_knowledge(rag.KNOWLEDGE_DIR, scale)
+        rebuilds = max(1, min(5, repeat // 40))
+
+        def cold(_):
+            shutil.rmtree(rag.INDEX_DIR, ignore_errors=True)
+            rag.load_knowledge()
+
+        rows.append(_time(f"load_knowledge cold/{scale}", cold, rebuilds))
+        rows.append(_time(f"load_knowledge warm/{scale}", lambda _: rag.load_knowledge(), rebuilds))
+
+        queries = QUESTIONS * (repeat // len(QUESTIONS) + 1)
+        rows.append(_time(f"retrieve/{scale}", lambda i: rag.retrieve(queries[i]), repeat))
+        rows.append(_time(f"best_passage/{scale}", lambda i: rag.best_passage(queries[i]), repeat))
+        rows.append(_time(f"retrieve_many x{len(QUESTIONS)}/{scale}",
+                          lambda _: rag.retrieve_many(QUESTIONS), max(1, repeat // 10)))
+
+        raw     = make_raw_data(scale=scale)
+        context = prepare_context(raw, "student")
+        for role in ("student", "parent", "faculty"):
+            rows.append(_time(f"filter_data_for_role {role}/{scale}",
+                              lambda _: filter_data_for_role(raw, role), repeat))
+        rows.append(_time(f"prepare_context/{scale}", lambda _: prepare_context(raw, "student"), repeat))
+        rows.append(_time(f"build_ai_context/{scale}",
+                          lambda i: build_ai_context(context, queries[i]), repeat))
+        rows.append(_time(f"payload.encode /me/{scale}",
+                          lambda _: payload.encode({"data": raw, "role": "student"}), repeat))
+    return rows
@@ -0,0 +1,45 @@
+import json
+
+
+def percentile(sorted_samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted samples."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_samples)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def summarise(name: str, samples: list[float], elapsed: float | None = None, errors: int = 0) -> dict:
+    """Latency summary in milliseconds for `samples` given in seconds."""
+    ordered = sorted(samples)
+    row = {
+        "name":   name,
+        "n":      len(ordered),
+        "errors": errors,
+        "mean":   1000 * sum(ordered) / len(ordered) if ordered else 0.0,
+        "p50":    1000 * percentile(ordered, 50),
+        "p95":    1000 * percentile(ordered, 95),
+        "p99":    1000 * percentile(ordered, 99),
+    }
+    if elapsed:
+        row["rps"] = len(ordered) / elapsed
+    return row
+
+
+def print_row(row: dict) -> None:
+    line = (
+        f"[BENCH] {row['name']:<40} n={row['n']:<6} "
+        f"mean {row['mean']:9.3f}ms  p50 {row['p50']:9.3f}ms  "
+        f"p95 {row['p95']:9.3f}ms  p99 {row['p99']:9.3f}ms"
+    )
+    if "rps" in row:
+        line += f"  {row['rps']:8.1f} req/s"
+    if row.get("errors"):
+        line += f"  errors={row['errors']}"
+    print(line)
+
+
+def write_json(rows: list[dict], path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+    print(f"[BENCH] Wrote {len(rows)} results to {path}")
@@ -0,0 +1,79 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from bench.report import print_row, summarise
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Loaded on first use or by the background warm-up, never by `import main`
+DEFERRED = ("google.genai", "pesuacademy", "numpy", "scipy")
+
+_IMPORT = (
+    "import sys, time\n"
+    "t = time.perf_counter()\n"
+    "import main\n"
+    "print(time.perf_counter() - t)\n"
+    f"print(','.join(m for m in {DEFERRED!r} if m in sys.modules))\n"
+)
+
+_READY = (
+    "import asyncio, time\n"
+    "t = time.perf_counter()\n"
+    "import httpx, main\n"
+    "async def go():\n"
+    "    await main.startup()\n"
+    "    transport = httpx.ASGITransport(app=main.app)\n"
+    "    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:\n"
+    "        while (await client.get('/api/ready')).status_code != 200:\n"
+    "            await asyncio.sleep(0.01)\n"
+    "    print(time.perf_counter() - t)\n"
+    "    await main.shutdown()\n"
+    "asyncio.run(go())\n"
+)
+
+
+def _python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def _slowest_imports(limit: int = 8) -> list[tuple[int, str]]:
+    """(cumulative microseconds, module) of the slowest imports under `import main`."""
+    out  = _python("import main", "-X", "importtime").stderr
+    rows = []
+    for line in out.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def run(budget: float = 1.0, repeat: int = 5) -> tuple[list[dict], bool]:
+    """
+    Time `import main` and startup to a 200 from /api/ready in fresh
+    interpreters. Fails when the median import exceeds `budget` seconds or
+    any DEFERRED module is imported with the app.
+    """
+    imports, ready, loaded = [], [], set()
+    for _ in range(repeat):
+        lines = _python(_IMPORT).stdout.splitlines()
+        imports.append(float(lines[-2]))
+        loaded.update(m for m in lines[-1].split(",") if m)
+        ready.append(float(_python(_READY).stdout.strip().splitlines()[-1]))
+
+    rows = [summarise("import main", imports), summarise("startup to /api/ready", ready)]
+    for row in rows:
+        print_row(row)
+
+    ok = True
+    if rows[0]["p50"] > budget * 1000:
+        ok = False
+        print(f"[BENCH] Import budget exceeded: p50 {rows[0]['p50']:.0f}ms > {budget * 1000:.0f}ms. Slowest:")
+        for micros, module in _slowest_imports():
+            print(f"[BENCH]   {micros / 1000:8.1f}ms  {module}")
+    if loaded:
+        ok = False
+        print(f"[BENCH] Imported with the app but should load lazily: {', '.join(sorted(loaded))}")
+    if ok:
+        print(f"[BENCH] Import within budget ({budget * 1000:.0f}ms), no deferred SDK imported")
+    return rows, ok
@@ -0,0 +1,296 @@
+import asyncio
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# "memory" keeps entries per worker, "sqlite" shares them across workers
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_PATH    = os.getenv("CACHE_PATH", "cache.sqlite3")
+
+PURGE_INTERVAL = 60   # seconds between sweeps of expired entries
+
+# Every cache built by make_cache(), swept by sweep_forever() and exported on /metrics
+_registry: list = []
+
+
+def _sizeof(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8", errors="ignore"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class MemoryCache:
+    """
+    In-process LRU cache bounded by entry count and total value bytes.
+    Entries expire after `ttl` seconds; expired entries are dropped on
+    access, swept at most every PURGE_INTERVAL seconds on writes, and
+    swept in the background by sweep_forever().
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.ttl         = ttl
+        self._data: OrderedDict[str, tuple[object, float, int]] = OrderedDict()   # key -> (value, expires_at, size)
+        self._bytes      = 0
+        self._lock       = threading.Lock()
+        self._last_purge = time.monotonic()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, _ = entry
+            if time.time() >= expires_at:
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, ttl: float | None = None) -> None:
+        size = _sizeof(value)
+        with self._lock:
+            if size > self.max_bytes:   # never fits; don't leave the previous value behind
+                if key in self._data:
+                    self._drop(key)
+                return
+            self._insert(key, value, ttl, size)
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        """Set `key` only if it is absent or expired; True if this call set it."""
+        size = _sizeof(value)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return False
+            if size > self.max_bytes:
+                if entry is not None:   # the expired value must not outlive a failed add
+                    self._drop(key)
+                return False
+            self._insert(key, value, ttl, size)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_expired()
+
+    def items(self) -> list[tuple[str, object]]:
+        """Snapshot of live (key, value) pairs; does not touch LRU order."""
+        now = time.time()
+        with self._lock:
+            return [(k, v) for k, (v, expires_at, _) in self._data.items() if now < expires_at]
+
+    def stats(self) -> dict:
+        return {
+            "backend":     "memory",
+            "entries":     len(self._data),
+            "bytes":       self._bytes,
+            "hits":        self.hits,
+            "misses":      self.misses,
+            "evictions":   self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _insert(self, key: str, value, ttl: float | None, size: int) -> None:
+        if key in self._data:
+            self._drop(key)
+        self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl), size)
+        self._bytes += size
+
+        if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+            self._purge_expired()
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def _purge_expired(self) -> int:
+        now     = time.time()
+        expired = [k for k, (_, expires_at, _) in self._data.items() if now >= expires_at]
+        for key in expired:
+            self._drop(key)
+        self.expirations += len(expired)
+        self._last_purge  = time.monotonic()
+        return len(expired)
+
+
+class SQLiteCache:
+    """
+    Same interface as MemoryCache, backed by a WAL-mode SQLite table so
+    every uvicorn worker on the host reads and writes the same entries.
+    Values are pickled; hit/miss counters are per process. The entry and
+    byte bounds are enforced, least recently read first, on each sweep.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int = 1024,
+                 max_bytes: int = 16 * 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.ttl         = ttl
+        self._table      = table
+        self._lock       = threading.Lock()
+        self._last_purge = 0.0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL, size INTEGER DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if "size" not in columns:   # tables created before the byte bound
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN size INTEGER DEFAULT 0")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed_at)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self._table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now >= row[1]:
+                self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self._table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None) -> None:
+        now  = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if len(blob) > self.max_bytes:   # never fits; don't leave the previous value behind
+                self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+                return
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self._table} VALUES (?, ?, ?, ?, ?)",
+                (key, blob, now + (self.ttl if ttl is None else ttl), now, len(blob)),
+            )
+            if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+                self._purge_expired()
+                self._trim()
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        now  = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    f"DELETE FROM {self._table} WHERE key = ? AND expires_at <= ?", (key, now)
+                )
+                if len(blob) > self.max_bytes:
+                    self._conn.execute("COMMIT")
+                    return False
+                cur = self._conn.execute(
+                    f"INSERT OR IGNORE INTO {self._table} VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, now + (self.ttl if ttl is None else ttl), now, len(blob)),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            expired = self._purge_expired()
+            self._trim()
+            return expired
+
+    def items(self) -> list[tuple[str, object]]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, value FROM {self._table} WHERE expires_at > ?", (time.time(),)
+            ).fetchall()
+        return [(key, pickle.loads(blob)) for key, blob in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self._table}"
+            ).fetchone()
+        return {
+            "backend":     "sqlite",
+            "entries":     entries,
+            "bytes":       size,
+            "hits":        self.hits,
+            "misses":      self.misses,
+            "evictions":   self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _purge_expired(self) -> int:
+        cur = self._conn.execute(f"DELETE FROM {self._table} WHERE expires_at <= ?", (time.time(),))
+        self.expirations += cur.rowcount
+        self._last_purge  = time.monotonic()
+        return cur.rowcount
+
+    def _trim(self) -> None:
+        # keep the most recently read entries while both bounds hold
+        cur = self._conn.execute(
+            f"DELETE FROM {self._table} WHERE key IN ("
+            f"SELECT key FROM (SELECT key, "
+            f"ROW_NUMBER() OVER (ORDER BY accessed_at DESC) AS n, "
+            f"SUM(size) OVER (ORDER BY accessed_at DESC ROWS UNBOUNDED PRECEDING) AS total "
+            f"FROM {self._table}) WHERE n > ? OR total > ?)",
+            (self.max_entries, self.max_bytes),
+        )
+        self.evictions += cur.rowcount
+
+
+def make_cache(name: str, max_entries: int, max_bytes: int, ttl: float):
+    """Build the cache selected by CACHE_BACKEND; `name` is the SQLite table."""
+    if CACHE_BACKEND == "sqlite":
+        cache = SQLiteCache(CACHE_PATH, name, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+    else:
+        cache = MemoryCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+    cache.name = name
+    _registry.append(cache)
+    return cache
+
+
+async def sweep_forever(interval: float = PURGE_INTERVAL) -> None:
+    """Background task: purge expired entries from every cache periodically."""
+    while True:
+        await asyncio.sleep(interval)
+        for cache in _registry:
+            try:
+                cache.purge_expired()
+            except Exception as e:
+                print(f"[CACHE] Sweep failed: {e}")
@@ -0,0 +1,63 @@
+import os
+import re
+
+# Per-session chat memory: the last HISTORY_TURNS exchanges are kept word for
+# word and older ones are folded into a rolling summary of one short line
+# each, so the conversation block of a prompt stays bounded however long the
+# chat runs. Only questions and replies are kept; the user's data and the
+# knowledge base are rebuilt fresh in every prompt.
+HISTORY_TURNS  = int(os.getenv("CHAT_HISTORY_TURNS", "4"))
+QUESTION_CHARS = 300   # per recent question
+REPLY_CHARS    = 600   # per recent reply
+SUMMARY_CHARS  = 800   # whole rolling summary; its oldest lines are dropped past this
+GIST_CHARS     = 120   # a question or reply inside one summary line
+
+
+def new() -> dict:
+    return {"summary": [], "turns": [], "folded": 0}
+
+
+def _clip(text: str, limit: int) -> str:
+    text = text.strip()
+    return text if len(text) <= limit else text[:limit].rstrip() + " …(truncated)"
+
+
+def _gist(text: str, limit: int = GIST_CHARS) -> str:
+    """First sentence of `text` on one line, without markdown, cut to `limit` chars."""
+    flat  = " ".join(re.sub(r"[*_`#>|]+|-{3,}", " ", text).split())
+    first = re.split(r"(?<=[.!?])\s", flat, maxsplit=1)[0]
+    return first if len(first) <= limit else first[: limit - 1].rstrip() + "…"
+
+
+def add_turn(conversation: dict, question: str, reply: str) -> dict:
+    """Append one exchange, folding the oldest verbatim turns into the summary."""
+    turns = conversation["turns"]
+    turns.append([_clip(question, QUESTION_CHARS), _clip(reply, REPLY_CHARS)])
+    while len(turns) > HISTORY_TURNS:
+        asked, answered = turns.pop(0)
+        conversation["summary"].append(f"- Asked: {_gist(asked)} Answered: {_gist(answered)}")
+    summary = conversation["summary"]
+    while summary and sum(len(line) + 1 for line in summary) > SUMMARY_CHARS:
+        summary.pop(0)
+        conversation["folded"] += 1
+    return conversation
+
+
+def last_question(conversation: dict | None) -> str:
+    if not conversation or not conversation["turns"]:
+        return ""
+    return conversation["turns"][-1][0]
+
+
+def render(conversation: dict | None) -> str:
+    """The conversation block of a prompt, or "" before the first exchange."""
+    if not conversation or not (conversation["turns"] or conversation["summary"]):
+        return ""
+    lines = ["CONVERSATION SO FAR (for follow-up questions; the data above is current):"]
+    if conversation["summary"]:
+        dropped = conversation["folded"]
+        lines.append(f"Earlier{f' ({dropped} older exchanges omitted)' if dropped else ''}:")
+        lines.extend(conversation["summary"])
+    for asked, answered in conversation["turns"]:
+        lines.append(f"USER: {asked}\nASSISTANT: {answered}")
+    return "\n".join(lines)
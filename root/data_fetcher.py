@@ -1,79 +1,375 @@
-from pesuacademy import PESUAcademy
+from cache import make_cache
+from metrics import stage
 import asyncio
+import hashlib
+import json
+import os
+import time
 
 
-async def fetch_student_data(username: str, password: str) -> dict:
-    pesu = None
+# Logged-in portal clients are kept per user and reused across fetches; the
+# underlying HTTP client keeps its connections alive between calls.
+MAX_UPSTREAM    = int(os.getenv("PORTAL_MAX_CONNECTIONS", "8"))     # concurrent portal operations per worker
+CLIENT_IDLE_TTL = int(os.getenv("PORTAL_CLIENT_IDLE_TTL", "600"))   # seconds before an unused client is closed
+
+FAILURE_TTL     = int(os.getenv("PORTAL_FAILURE_TTL", "20"))       # seconds a failed fetch is replayed to callers
+
+# The pesuacademy SDK is imported on the first portal call (or by warm_up()),
+# not with the app, to keep cold starts short
+PESUAcademy = None
+
+
+def _portal():
+    global PESUAcademy
+    if PESUAcademy is None:
+        from pesuacademy import PESUAcademy
+    return PESUAcademy
+
+
+def warm_up() -> None:
+    """Import the portal SDK ahead of the first login; safe to run in a thread."""
+    _portal()
+
+
+# (username, password hash) -> {"client": PESUAcademy | None, "last_used": float, "lock": asyncio.Lock}
+_clients: dict[tuple[str, str], dict] = {}
+_public_client = None
+_upstream      = asyncio.Semaphore(MAX_UPSTREAM)
+
+
+def _client_key(username: str, password: str) -> tuple[str, str]:
+    # The password is part of the key so a wrong password never reuses a live login
+    return username, hashlib.sha256(password.encode()).hexdigest()
+
+
+async def _close(client) -> None:
     try:
-        pesu = await PESUAcademy.login(username=username, password=password)
-        attendance_data, timetable_data, profile_data = await asyncio.gather(
-            pesu.get_attendance(),
-            pesu.get_timetable(),
-            pesu.get_profile(),
-        )
-        return {
-            "username":   username,
-            "attendance": _serialize_attendance(attendance_data),
-            "timetable":  _serialize_timetable(timetable_data),
-            "profile":    _serialize_profile(profile_data),
-        }
-    except Exception as e:
-        raise Exception(f"PESU fetch failed: {e}")
-    finally:
-        if pesu:
-            await pesu.close()
+        await client.close()
+    except Exception:
+        pass
+
+
+async def _evict_idle() -> None:
+    cutoff = time.monotonic() - CLIENT_IDLE_TTL
+    for key, entry in list(_clients.items()):
+        if entry["last_used"] < cutoff and not entry["lock"].locked():
+            _clients.pop(key, None)
+            if entry["client"]:
+                await _close(entry["client"])
+
+
+async def _with_portal(username: str, password: str, fetch):
+    """
+    Run `fetch(client, reused)` on the user's pooled, logged-in portal
+    client, logging in only when there is none. If a reused client fails
+    (e.g. the portal expired its session) it is dropped and the call
+    retried once on a fresh login.
+    """
+    await _evict_idle()
+    key = _client_key(username, password)
+    while True:
+        entry = _clients.setdefault(key, {"client": None, "last_used": time.monotonic(), "lock": asyncio.Lock()})
+        async with entry["lock"]:
+            if _clients.get(key) is not entry:   # dropped while we waited for the lock
+                continue
+            reused = entry["client"] is not None
+            try:
+                if not reused:
+                    async with _upstream:
+                        with stage("portal_login"):
+                            entry["client"] = await _portal().login(username=username, password=password)
+                async with _upstream:
+                    return await fetch(entry["client"], reused)
+            except Exception:
+                if _clients.get(key) is entry:   # release_user() may have dropped it already
+                    _clients.pop(key)
+                if entry["client"]:
+                    await _close(entry["client"])
+                    entry["client"] = None
+                if not reused:
+                    raise
+            finally:
+                entry["last_used"] = time.monotonic()
+
+
+async def _get_public_client():
+    global _public_client
+    if _public_client is None:
+        _public_client = _portal()()
+    return _public_client
+
+
+async def release_user(username: str, password: str) -> None:
+    """Close a user's pooled portal client, e.g. on logout."""
+    entry = _clients.pop(_client_key(username, password), None)
+    if entry and entry["client"]:
+        async with entry["lock"]:
+            await _close(entry["client"])
+
+
+async def close_all() -> None:
+    global _public_client
+    for entry in list(_clients.values()):
+        if entry["client"]:
+            await _close(entry["client"])
+    _clients.clear()
+    if _public_client is not None:
+        await _close(_public_client)
+        _public_client = None
+
+
+# ── Per-section refresh ────────────────────────────────────────────────────────
+# Each dataset has its own freshness window. Only the current semester's
+# attendance is re-fetched; past semesters are frozen once fetched, and the
+# full semester list is rescanned on login and weekly to pick up a new semester.
+SECTION_TTLS = {
+    "profile":      24 * 3600,
+    "timetable":    12 * 3600,
+    "attendance":   2 * 3600,          # current semester
+    "semesters":    7 * 24 * 3600,     # rescan of every semester
+    "section_info": 24 * 3600,         # faculty only
+}
+STATE_IDLE_TTL = 6 * 3600   # drop a user's section state after this long unused
+
+# "kind:username:password hash" -> {
+#     "version":    int, bumped whenever any section's content changes
+#     "current":    latest semester number seen
+#     "scanned_at": time of the last all-semester fetch
+#     "sections":   {name: {"data", "hash", "version", "fetched_at"}},
+# }   with names "profile", "timetable", "section_info", "attendance:<sem>"
+_user_state = make_cache(
+    "portal_state",
+    max_entries=int(os.getenv("PORTAL_STATE_MAX_ENTRIES", "10000")),
+    max_bytes=256 * 1024 * 1024,
+    ttl=STATE_IDLE_TTL,
+)
+
+
+def _state_key(kind: str, username: str, password: str) -> str:
+    return ":".join((kind, *_client_key(username, password)))
+
+
+def _hash(data) -> str:
+    blob = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def _put(state: dict, name: str, data, now: float) -> None:
+    """Store a section, bumping its version only if the content changed."""
+    digest  = _hash(data)
+    section = state["sections"].get(name)
+    if section and section["hash"] == digest:
+        section["fetched_at"] = now
+        return
+    state["version"] += 1
+    state["sections"][name] = {"data": data, "hash": digest, "version": state["version"], "fetched_at": now}
+
 
+def _due(state: dict, kind: str, now: float, refresh_all: bool) -> set[str]:
+    names = ["profile", "timetable"] + (["section_info"] if kind == "faculty" else [])
+    due   = set()
+    for name in names:
+        section = state["sections"].get(name)
+        if refresh_all or not section or now - section["fetched_at"] >= SECTION_TTLS[name]:
+            due.add(name)
 
-async def fetch_faculty_data(username: str, password: str) -> dict:
-    pesu = None
+    # a login rescans the semester list so a new semester shows up at once
+    current = state["sections"].get(f"attendance:{state['current']}")
+    if refresh_all or now - state["scanned_at"] >= SECTION_TTLS["semesters"]:
+        due.add("semesters")
+    elif not current or now - current["fetched_at"] >= SECTION_TTLS["attendance"]:
+        due.add("attendance")
+    return due
+
+
+def _put_attendance(state: dict, semesters: dict, now: float, scan: bool) -> None:
+    """Store per-semester attendance; `scan` marks a fetch of every semester."""
+    if not semesters:
+        return
+    previous = state["current"]
+    for sem in sorted(semesters, key=int):
+        name = f"attendance:{sem}"
+        # past semesters are frozen: only apply them the first time they are seen
+        if int(sem) < previous and name in state["sections"]:
+            continue
+        _put(state, name, semesters[sem], now)
+    if scan:
+        state["scanned_at"] = now
+    state["current"] = max(previous, max(int(sem) for sem in semesters))
+
+
+async def _fetch_section_info(profile: dict) -> dict:
     try:
-        pesu = await PESUAcademy.login(username=username, password=password)
-        attendance_data, timetable_data, profile_data = await asyncio.gather(
-            pesu.get_attendance(),
-            pesu.get_timetable(),
-            pesu.get_profile(),
+        section = (
+            profile.get("section") or profile.get("class_section") or
+            profile.get("branch_section") or profile.get("section_id") or ""
         )
-        profile = _serialize_profile(profile_data)
-
-        # Try to fetch class section info
-        section_info = {}
-        public_pesu = None
-        try:
-            section = (
-                profile.get("section") or profile.get("class_section") or
-                profile.get("branch_section") or profile.get("section_id") or ""
-            )
-            if section:
-                public_pesu = PESUAcademy()
+        if not section:
+            return {
+                "note": "Section field not found.",
+                "available_profile_keys": list(profile.keys()),
+            }
+        public_pesu = await _get_public_client()
+        async with _upstream:
+            with stage("portal_section_info"):
                 raw_section = await public_pesu.get_section_info(section=section)
-                section_info = raw_section.model_dump(mode="json") if raw_section else {}
+        return raw_section.model_dump(mode="json") if raw_section else {}
+    except Exception as se:
+        return {"note": f"Section info unavailable: {se}"}
+
+
+def _has(state: dict, name: str) -> bool:
+    if name in ("semesters", "attendance"):
+        return any(n.startswith("attendance:") for n in state["sections"])
+    return name in state["sections"]
+
+
+def _assemble(state: dict, kind: str, username: str) -> dict:
+    sections   = state["sections"]
+    semesters  = sorted((n.split(":", 1)[1] for n in sections if n.startswith("attendance:")), key=int)
+    attendance = {sem: sections[f"attendance:{sem}"]["data"] for sem in semesters}
+    data = {
+        "username":   username,
+        "attendance": attendance,
+        "timetable":  sections["timetable"]["data"],
+        "profile":    sections["profile"]["data"],
+        "version":    state["version"],
+    }
+    if kind == "faculty":
+        data["role"]         = "faculty"
+        data["section_info"] = sections["section_info"]["data"]
+    return data
+
+
+async def _refresh(kind: str, username: str, password: str, refresh_all: bool) -> dict:
+    """
+    Re-fetch only the sections that are due and return the assembled data.
+    A failure on a reused client retries everything on a fresh login; a
+    section that still fails keeps its previous value, and the call only
+    fails if a section has never been fetched successfully.
+    """
+    now   = time.time()
+    key   = _state_key(kind, username, password)
+    state = _user_state.get(key) or {
+        # versions start at a ms timestamp so they never repeat after the state is dropped
+        "version": int(now * 1000), "current": 0, "scanned_at": 0.0, "sections": {},
+    }
+    due = _due(state, kind, now, refresh_all)
+
+    portal = {
+        "profile":    lambda pesu: pesu.get_profile(),
+        "timetable":  lambda pesu: pesu.get_timetable(),
+        "semesters":  lambda pesu: pesu.get_attendance(),
+        "attendance": lambda pesu: pesu.get_attendance(semester=state["current"]),
+    }
+    names = [name for name in portal if name in due]
+    if names:
+        async def call(name, pesu):
+            with stage(f"portal_{name}"):
+                return await portal[name](pesu)
+
+        async def fetch(pesu, reused):
+            results = await asyncio.gather(*(call(name, pesu) for name in names), return_exceptions=True)
+            errors  = [r for r in results if isinstance(r, Exception)]
+            if errors and reused:   # maybe a session the portal expired: let _with_portal log in again
+                raise errors[0]
+            return results
+
+        results = dict(zip(names, await _with_portal(username, password, fetch)))
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                continue
+            if name == "profile":
+                _put(state, name, _serialize_profile(result), now)
+            elif name == "timetable":
+                _put(state, name, _serialize_timetable(result), now)
             else:
-                section_info = {
-                    "note": "Section field not found.",
-                    "available_profile_keys": list(profile.keys()),
-                }
-        except Exception as se:
-            section_info = {"note": f"Section info unavailable: {se}"}
-        finally:
-            if public_pesu:
-                try:
-                    await public_pesu.close()
-                except Exception:
-                    pass
-
-        return {
-            "username":     username,
-            "role":         "faculty",
-            "profile":      profile,
-            "attendance":   _serialize_attendance(attendance_data),
-            "timetable":    _serialize_timetable(timetable_data),
-            "section_info": section_info,
-        }
+                _put_attendance(state, _serialize_attendance(result), now, scan=name == "semesters")
+
+        failed = [r for n, r in results.items() if isinstance(r, Exception) and not _has(state, n)]
+        if failed:
+            raise failed[0]
+
+    if "section_info" in due:
+        _put(state, "section_info", await _fetch_section_info(state["sections"]["profile"]["data"]), now)
+
+    _user_state.set(key, state)
+    return _assemble(state, kind, username)
+
+
+def changes_since(username: str, password: str, role: str, since: int) -> dict:
+    """
+    Sections whose content changed after version `since`, for clients that
+    already hold that version. Unknown or future versions return everything.
+    """
+    kind  = "faculty" if role == "faculty" else "student"
+    state = _user_state.get(_state_key(kind, username, password))
+    if not state:
+        return {"version": 0, "changed": {}}
+    if since > state["version"]:
+        since = 0
+
+    changed = {}
+    for name, section in state["sections"].items():
+        if section["version"] <= since:
+            continue
+        if name.startswith("attendance:"):
+            changed.setdefault("attendance", {})[name.split(":", 1)[1]] = section["data"]
+        else:
+            changed[name] = section["data"]
+    return {"version": state["version"], "changed": changed}
+
+
+# Single-flight: (fetch kind, username, password hash) -> shared fetch task
+_inflight: dict[tuple, asyncio.Task] = {}
+_failures: dict[tuple, tuple[Exception, float]] = {}
+
+
+def _settle(key: tuple, task: asyncio.Task) -> None:
+    _inflight.pop(key, None)
+    now = time.monotonic()
+    for k, (_, ts) in list(_failures.items()):
+        if now - ts >= FAILURE_TTL:
+            del _failures[k]
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        _failures[key] = (exc, now)
+    else:
+        _failures.pop(key, None)
+
+
+async def fetch_user_data(username: str, password: str, role: str, refresh_all: bool = False) -> dict:
+    """
+    Portal data for a session role, refreshing only the sections whose TTL
+    has lapsed (all but frozen past semesters with `refresh_all`, as on
+    login). Concurrent callers for the same user await one shared fetch,
+    and a failure is re-raised to callers for FAILURE_TTL seconds instead
+    of hitting the portal again.
+    """
+    kind = "faculty" if role == "faculty" else "student"
+    key  = (kind, *_client_key(username, password))
+
+    failed = _failures.get(key)
+    if failed and time.monotonic() - failed[1] < FAILURE_TTL:
+        raise failed[0]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_guarded_refresh(kind, username, password, refresh_all))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _settle(key, t))
+    # shield: one caller disconnecting must not cancel the fetch for the others
+    return await asyncio.shield(task)
+
+
+async def _guarded_refresh(kind: str, username: str, password: str, refresh_all: bool) -> dict:
+    try:
+        return await _refresh(kind, username, password, refresh_all)
     except Exception as e:
-        raise Exception(f"Faculty PESU fetch failed: {e}")
-    finally:
-        if pesu:
-            await pesu.close()
+        prefix = "Faculty PESU fetch failed" if kind == "faculty" else "PESU fetch failed"
+        raise Exception(f"{prefix}: {e}")
 
 
 async def fetch_guest_data() -> dict:
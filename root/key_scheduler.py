@@ -0,0 +1,176 @@
+import asyncio
+import os
+import re
+import time
+from collections import deque
+
+# Per-key budgets, defaulting to the Gemini 2.5 Flash free tier. They are
+# tracked per process: with several workers, set each worker's share.
+KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "10"))
+KEY_TPM = int(os.getenv("GEMINI_KEY_TPM", "250000"))
+KEY_RPD = int(os.getenv("GEMINI_KEY_RPD", "250"))
+
+MAX_WAIT     = float(os.getenv("GEMINI_KEY_MAX_WAIT", "10"))   # seconds a call may wait for a key
+BACKOFF_BASE = 2.0     # first quarantine after a failure, doubled per consecutive failure
+BACKOFF_MAX  = 300.0
+WINDOW       = 60.0    # seconds covered by the RPM / TPM budgets
+DAY          = 24 * 3600
+
+# "'retryDelay': '37s'" (RetryInfo detail) or "Please retry in 37.4s."
+_RETRY_HINT = re.compile(r"retry(?:delay|[ _-]?after|\s+in)\W*(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+def retry_after(exc: Exception) -> float | None:
+    """Seconds the API asked us to wait, from a Retry-After header or the error body."""
+    response = getattr(exc, "response", None)
+    try:
+        header = response.headers.get("retry-after") if response is not None else None
+        if header:
+            return float(header)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    match = _RETRY_HINT.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def _status(exc: Exception) -> int | None:
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code
+    text  = str(exc).lower()
+    match = re.match(r"(\d{3}) ", text)   # "429 RESOURCE_EXHAUSTED. {...}"
+    if match:
+        return int(match.group(1))
+    if "429" in text or "resource_exhausted" in text or "quota" in text or "rate limit" in text:
+        return 429
+    return None
+
+
+class _Key:
+    """Budget and health of one API key."""
+
+    def __init__(self, client, index: int):
+        self.client        = client
+        self.index         = index
+        self.calls         = deque()   # [started_at, tokens] in the last WINDOW seconds
+        self.day_start     = time.monotonic()
+        self.day_count     = 0
+        self.blocked_until = 0.0
+        self.strikes       = 0
+
+    def _prune(self, now: float) -> None:
+        while self.calls and now - self.calls[0][0] >= WINDOW:
+            self.calls.popleft()
+        if now - self.day_start >= DAY:
+            self.day_start, self.day_count = now, 0
+
+    def headroom(self, now: float, tokens: int) -> tuple[float | None, float]:
+        """(fraction of the tightest budget left after this call or None if over, time it frees up)."""
+        self._prune(now)
+        if now < self.blocked_until:
+            return None, self.blocked_until
+        if self.day_count >= KEY_RPD:
+            return None, self.day_start + DAY
+
+        used = sum(t for _, t in self.calls)
+        if len(self.calls) >= KEY_RPM or (self.calls and used + tokens > KEY_TPM):
+            return None, self.calls[0][0] + WINDOW
+        room = min(
+            1 - (len(self.calls) + 1) / KEY_RPM,
+            1 - (used + tokens) / KEY_TPM,
+            1 - (self.day_count + 1) / KEY_RPD,
+        )
+        return room, now
+
+
+class Lease:
+    """One call on a key; report its outcome with ok() or failed()."""
+
+    __slots__ = ("key", "_entry", "_scheduler")
+
+    def __init__(self, scheduler: "KeyScheduler", key: _Key, entry: list):
+        self._scheduler = scheduler
+        self.key        = key
+        self._entry     = entry
+
+    @property
+    def client(self):
+        return self.key.client
+
+    def ok(self, tokens: int | None = None) -> None:
+        if tokens:
+            self._entry[1] = tokens
+        self.key.strikes = 0
+
+    def failed(self, exc: Exception) -> None:
+        self._scheduler._quarantine(self.key, exc)
+
+
+class KeyScheduler:
+    """
+    Routes each Gemini call to the key with the most headroom across its
+    request, token and daily budgets. Keys that fail are quarantined with
+    exponential backoff, or for as long as a rate-limit error asks. When
+    every key is out of budget, acquire() waits up to MAX_WAIT seconds
+    for one to free up instead of failing the call.
+    """
+
+    def __init__(self, clients: list):
+        self._keys = [_Key(client, i) for i, client in enumerate(clients)]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    async def acquire(self, tokens: int, exclude: set[int] = frozenset()) -> Lease | None:
+        """Reserve budget for a call of about `tokens` tokens; None if no key frees up in time."""
+        deadline = time.monotonic() + MAX_WAIT
+        while True:
+            now        = time.monotonic()
+            best, room = None, -1.0
+            wake       = None
+            for key in self._keys:
+                if key.index in exclude:
+                    continue
+                key_room, ready_at = key.headroom(now, tokens)
+                if key_room is None:
+                    wake = ready_at if wake is None else min(wake, ready_at)
+                elif key_room > room:
+                    best, room = key, key_room
+
+            if best is not None:
+                entry = [now, tokens]
+                best.calls.append(entry)
+                best.day_count += 1
+                return Lease(self, best, entry)
+            if wake is None or wake > deadline:
+                return None
+            await asyncio.sleep(max(wake - now, 0.05))
+
+    def _quarantine(self, key: _Key, exc: Exception) -> None:
+        status = _status(exc)
+        if status in (400, 404):   # the request's fault, not the key's
+            return
+        key.strikes += 1
+        if status in (401, 403):
+            delay = BACKOFF_MAX
+        else:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (key.strikes - 1))
+            if status == 429:
+                delay = max(delay, retry_after(exc) or 0.0)
+        key.blocked_until = max(key.blocked_until, time.monotonic() + delay)
+        print(f"[AI] Key {key.index + 1} quarantined for {delay:.0f}s ({status or type(exc).__name__})")
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        out = []
+        for key in self._keys:
+            key._prune(now)
+            out.append({
+                "key":           key.index + 1,
+                "requests_1m":   len(key.calls),
+                "tokens_1m":     sum(t for _, t in key.calls),
+                "requests_day":  key.day_count,
+                "blocked_for":   round(max(0.0, key.blocked_until - now), 1),
+                "strikes":       key.strikes,
+            })
+        return out
@@ -1,23 +1,82 @@
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+import json
+import os
+import random
+
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from auth import create_session, get_session, delete_session
-from data_fetcher import fetch_student_data, fetch_faculty_data, fetch_guest_data
-from security import filter_data_for_role, build_ai_context
-from ai_handler import ask_ai
-from rag import load_knowledge
+from auth import create_session, get_session, delete_session, live_sessions, SESSION_TTL
+from auth import credentials_in_use, get_conversation, save_turn
+from data_fetcher import fetch_user_data, fetch_guest_data, changes_since, release_user, close_all
+from data_fetcher import warm_up as warm_up_portal
+from security import prepare_context, build_ai_context, detect_intent, direct_answer
+from ai_handler import ask_ai, stream_ai, admission_stats, key_stats, close_context_caches
+from ai_handler import warm_up as warm_up_ai
+from admission import PRIORITY_GUEST, PRIORITY_USER
+from rag import is_loaded, load_knowledge
+from cache import make_cache, sweep_forever, _registry as cache_registry
+import metrics
+import payload
 
 app = FastAPI(title="PESU Reimagined API")
 
-data_cache       = {}
-guest_data_cache = {}
+DATA_CACHE_MAX_ENTRIES = int(os.getenv("DATA_CACHE_MAX_ENTRIES", "10000"))
+DATA_CACHE_MAX_BYTES   = int(os.getenv("DATA_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# token -> payload.encode() of the /me body, and token -> prepare_context() of its data
+data_cache    = make_cache("user_data", DATA_CACHE_MAX_ENTRIES, DATA_CACHE_MAX_BYTES, ttl=SESSION_TTL)
+context_cache = make_cache("user_context", DATA_CACHE_MAX_ENTRIES, DATA_CACHE_MAX_BYTES, ttl=SESSION_TTL)
+# "data" -> public guest data, "context" -> its prepared context
+guest_data_cache = make_cache("guest_data", max_entries=4, max_bytes=1024 * 1024, ttl=24 * 3600)
+
+# Background refresh of every active session's portal data; 0 disables it
+# and /me, /chat refresh on the request path instead
+PREFETCH_INTERVAL    = int(os.getenv("PREFETCH_INTERVAL", "300"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "4"))   # keep below PORTAL_MAX_CONNECTIONS
+PREFETCH_JITTER      = 0.2
+
+# "role:username" -> pid of the worker refreshing that user this round
+prefetch_leases = make_cache(
+    "prefetch_leases", DATA_CACHE_MAX_ENTRIES, 1024 * 1024,
+    ttl=PREFETCH_INTERVAL * (1 - PREFETCH_JITTER),
+)
+
+
+# Import the Gemini and portal SDKs in the background after startup; 0 leaves
+# them to the first request that needs them
+WARM_UP = os.getenv("WARM_UP", "1") != "0"
 
 
 @app.on_event("startup")
 async def startup():
-    load_knowledge()
+    # Nothing slow runs before the worker accepts requests: the knowledge
+    # index and the SDKs load in threads, and /api/ready reports when done
+    app.state.warmup = {"knowledge": asyncio.create_task(asyncio.to_thread(load_knowledge))}
+    if WARM_UP:
+        app.state.warmup["gemini"] = asyncio.create_task(asyncio.to_thread(warm_up_ai))
+        app.state.warmup["portal"] = asyncio.create_task(asyncio.to_thread(warm_up_portal))
+    for name, task in app.state.warmup.items():
+        task.add_done_callback(lambda task, name=name: _log_warmup(name, task))
+    app.state.sweeper    = asyncio.create_task(sweep_forever())
+    app.state.prefetcher = asyncio.create_task(prefetch_forever()) if PREFETCH_INTERVAL > 0 else None
+
+
+def _log_warmup(name: str, task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        print(f"[STARTUP] Warm-up of {name} failed: {task.exception()!r}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.sweeper.cancel()
+    if app.state.prefetcher:
+        app.state.prefetcher.cancel()
+    await close_all()
+    await close_context_caches()
 
 
 app.add_middleware(
@@ -26,6 +85,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Pre-encoded /me bodies and SSE streams pass through uncompressed by this
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+# Outermost, so request timings include compression
+app.add_middleware(metrics.RequestMetrics)
 
 
 class LoginRequest(BaseModel):
@@ -73,6 +136,58 @@ def health():
     return {"message": "PESU Reimagined is running!", "modes": ["student", "faculty", "guest"]}
 
 
+# Prometheus scrape target 
+CACHE_HITS      = metrics.gauge("pesu_cache_hits_total", "Cache hits by cache.", kind="counter")
+CACHE_MISSES    = metrics.gauge("pesu_cache_misses_total", "Cache misses by cache.", kind="counter")
+CACHE_ENTRIES   = metrics.gauge("pesu_cache_entries", "Entries held by cache.")
+KEY_REQUESTS    = metrics.gauge("pesu_llm_key_requests_1m", "Gemini requests in the last minute, by key.")
+KEY_BLOCKED     = metrics.gauge("pesu_llm_key_blocked_seconds", "Seconds left in a key's quarantine.")
+LLM_IN_FLIGHT   = metrics.gauge("pesu_llm_in_flight", "Admitted Gemini calls by priority.")
+LLM_QUEUED      = metrics.gauge("pesu_llm_queued", "Gemini calls waiting for admission, by priority.")
+LLM_SHED        = metrics.gauge("pesu_llm_shed_total", "Gemini calls shed by admission control.", kind="counter")
+
+
+@metrics.collector
+def _collect():
+    for cache in cache_registry:
+        stats = cache.stats()
+        CACHE_HITS.set(stats["hits"], cache=cache.name)
+        CACHE_MISSES.set(stats["misses"], cache=cache.name)
+        CACHE_ENTRIES.set(stats["entries"], cache=cache.name)
+    for key in key_stats():
+        KEY_REQUESTS.set(key["requests_1m"], key=key["key"])
+        KEY_BLOCKED.set(key["blocked_for"], key=key["key"])
+    admission = admission_stats()
+    for priority, label in ((PRIORITY_USER, "user"), (PRIORITY_GUEST, "guest")):
+        LLM_IN_FLIGHT.set(admission["in_flight"][priority], priority=label)
+        LLM_QUEUED.set(admission["queued"][priority], priority=label)
+    LLM_SHED.set(admission["shed"])
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Readiness: 503 until the background warm-up has finished, unlike /api/health
+@app.get("/api/ready")
+def ready():
+    pending = [name for name, task in app.state.warmup.items() if not task.done()]
+    failed  = [name for name, task in app.state.warmup.items() if task.done() and task.exception()]
+    body    = {"ready": not pending and not failed, "pending": pending, "failed": failed, "knowledge": is_loaded()}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+async def _knowledge_ready() -> None:
+    # shield: one caller disconnecting must not cancel the load for the others.
+    # A failed load is logged once and reported by /api/ready; chats then go
+    # on without the knowledge base (is_loaded() is False)
+    try:
+        await asyncio.shield(app.state.warmup["knowledge"])
+    except Exception:
+        pass
+
+
 # Root redirect -> login page 
 @app.get("/")
 def root():
@@ -84,10 +199,10 @@ async def debug_data(token: str = Query(...)):
     session = get_session(token)
     if not session:
         raise HTTPException(401, detail="Session expired.")
-    raw = data_cache.get(token)
-    if not raw:
+    cached = data_cache.get(token)
+    if not cached:
         raise HTTPException(404, detail="No cached data. Log in first.")
-    import json
+    raw = payload.loads(cached["body"])["data"]
     # Showing just the first course and first timetable slot so field names are clear
     att = raw.get("attendance", {})
     sem_keys = sorted([k for k in att.keys() if str(k).isdigit()], key=int)
@@ -105,111 +220,319 @@ async def debug_data(token: str = Query(...)):
     }
 
 
+def _store_data(token: str, raw: dict, role: str) -> tuple[dict, dict]:
+    """
+    Cache a user's portal data as the pre-encoded /me response, together
+    with its prepared prompt context. Returns (payload, context).
+    """
+    body    = payload.encode({"data": raw, "role": role, "username": raw["username"]}, version=raw.get("version"))
+    context = prepare_context(raw, role)
+    data_cache.set(token, body)
+    context_cache.set(token, context)
+    return body, context
+
+
+async def _session_data(token: str, session: dict) -> dict:
+    """
+    Return the session's encoded /me payload. With the prefetch scheduler
+    running the cached copy is served as-is and only a cold cache hits the
+    portal; otherwise stale sections are refreshed here, falling back to
+    cached data if the portal is unreachable.
+    """
+    cached = data_cache.get(token)
+    if cached and PREFETCH_INTERVAL > 0:
+        return cached
+    try:
+        raw = await fetch_user_data(session["username"], session["password"], session["role"])
+    except Exception as e:
+        if cached:
+            return cached
+        raise HTTPException(500, detail=_clean_error(str(e)))
+    if cached and cached["version"] == raw.get("version"):
+        return cached
+    return _store_data(token, raw, session["role"])[0]
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    tags = request.headers.get("if-none-match", "")
+    if tags.strip() == "*":
+        return True
+    # the gzip variant's tag is the body tag with a "-gz" suffix
+    return any(t.strip().removeprefix("W/").replace('-gz"', '"') == etag for t in tags.split(","))
+
+
+def _json_response(request: Request, body: dict, **fields) -> Response:
+    """
+    Serve a payload.encode() body, gzipped if the client accepts it, or a
+    304 if the client already holds it (If-None-Match).
+    """
+    if fields:   # per-request fields (the login token) make the cached gzip/ETag inapplicable
+        return Response(payload.with_fields(body, **fields), media_type="application/json")
+
+    gzipped = body["gzip"] and "gzip" in request.headers.get("accept-encoding", "")
+    headers = {
+        "ETag":          body["etag"][:-1] + '-gz"' if gzipped else body["etag"],
+        "Vary":          "Accept-Encoding",
+        "Cache-Control": "private, no-cache",   # browsers keep it but revalidate every time
+    }
+    if _etag_matches(request, body["etag"]):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return Response(body["gzip"], media_type="application/json", headers=headers)
+    return Response(body["body"], media_type="application/json", headers=headers)
+
+
+async def _prefetch_user(session: dict, tokens: list[str], limit: asyncio.Semaphore) -> None:
+    # Spread each round's portal calls over the jitter window
+    await asyncio.sleep(random.uniform(0, PREFETCH_INTERVAL * PREFETCH_JITTER))
+    async with limit:
+        try:
+            raw = await fetch_user_data(session["username"], session["password"], session["role"])
+        except Exception as e:
+            print(f"[PREFETCH] {session['role']} {session['username']} failed: {e}")
+            return
+    for token in tokens:
+        cached = data_cache.get(token)
+        if not cached or cached["version"] != raw.get("version"):
+            _store_data(token, raw, session["role"])
+
+
+async def prefetch_forever() -> None:
+    """
+    Background task: every PREFETCH_INTERVAL (±PREFETCH_JITTER) seconds,
+    refresh the due portal sections of every active session's user, at
+    most PREFETCH_CONCURRENCY at a time. A per-user lease in the shared
+    store stops several workers refreshing the same user in one round.
+    """
+    limit = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL * random.uniform(1 - PREFETCH_JITTER, 1 + PREFETCH_JITTER))
+
+        users: dict[tuple, tuple[dict, list[str]]] = {}
+        for token, session in live_sessions():
+            key = (session["role"], session["username"], session["password"])
+            users.setdefault(key, (session, []))[1].append(token)
+
+        jobs = [
+            _prefetch_user(session, tokens, limit)
+            for session, tokens in users.values()
+            if prefetch_leases.add(f"{session['role']}:{session['username']}", os.getpid())
+        ]
+        if jobs:
+            await asyncio.gather(*jobs, return_exceptions=True)
+            print(f"[PREFETCH] Refreshed {len(jobs)} user(s)")
+
+
 # returns cached data for the session (dashboard refresh) 
 @app.get("/me")
-async def me(token: str = Query(...)):
+async def me(request: Request, token: str = Query(...)):
     session = get_session(token)
     if not session:
         raise HTTPException(401, detail="Session expired. Please log in again.")
-    raw = data_cache.get(token)
-    if not raw:
-        try:
-            if session["role"] == "faculty":
-                raw = await fetch_faculty_data(session["username"], session["password"])
-            else:
-                raw = await fetch_student_data(session["username"], session["password"])
-            data_cache[token] = raw
-        except Exception as e:
-            raise HTTPException(500, detail=_clean_error(str(e)))
-    return {"data": raw, "role": session["role"], "username": session["username"]}
+    return _json_response(request, await _session_data(token, session))
+
+
+# only the sections that changed since the client's `version` 
+@app.get("/me/changes")
+async def me_changes(token: str = Query(...), since: int = Query(0)):
+    session = get_session(token)
+    if not session:
+        raise HTTPException(401, detail="Session expired. Please log in again.")
+    await _session_data(token, session)
+    changes = changes_since(session["username"], session["password"], session["role"], since)
+    return {**changes, "role": session["role"], "username": session["username"]}
 
 
 # Student login 
 @app.post("/login")
-async def login(body: LoginRequest):
+async def login(request: Request, body: LoginRequest):
     if not body.username or not body.password:
         raise HTTPException(400, detail="Please enter your username and password.")
     try:
-        raw_data = await fetch_student_data(body.username, body.password)
+        raw_data = await fetch_user_data(body.username, body.password, "student", refresh_all=True)
     except Exception as e:
         raise HTTPException(401, detail=_clean_error(str(e)))
     token = create_session(body.username, body.password, "student")
-    data_cache[token] = raw_data
-    return {"token": token, "role": "student", "username": body.username, "data": raw_data}
+    encoded, _ = _store_data(token, raw_data, "student")
+    return _json_response(request, encoded, token=token)
 
 
 # Faculty login 
 @app.post("/faculty-login")
-async def faculty_login(body: LoginRequest):
+async def faculty_login(request: Request, body: LoginRequest):
     if not body.username or not body.password:
         raise HTTPException(400, detail="Please enter your faculty ID and password.")
     try:
-        raw_data = await fetch_faculty_data(body.username, body.password)
+        raw_data = await fetch_user_data(body.username, body.password, "faculty", refresh_all=True)
     except Exception as e:
         raise HTTPException(401, detail=_clean_error(str(e)))
     token = create_session(body.username, body.password, "faculty")
-    data_cache[token] = raw_data
-    return {"token": token, "role": "faculty", "username": body.username, "data": raw_data}
+    encoded, _ = _store_data(token, raw_data, "faculty")
+    return _json_response(request, encoded, token=token)
 
 
 # Parent login 
 @app.post("/parent-login")
-async def parent_login(body: LoginRequest):
+async def parent_login(request: Request, body: LoginRequest):
     """Parent logs in with the ward's SRN and password."""
     if not body.username or not body.password:
         raise HTTPException(400, detail="Please enter the ward's SRN and password.")
     try:
-        raw_data = await fetch_student_data(body.username, body.password)
+        raw_data = await fetch_user_data(body.username, body.password, "parent", refresh_all=True)
     except Exception as e:
         raise HTTPException(401, detail=_clean_error(str(e)))
     token = create_session(body.username, body.password, "parent")
-    data_cache[token] = raw_data
-    return {"token": token, "role": "parent", "username": body.username, "data": raw_data}
+    encoded, _ = _store_data(token, raw_data, "parent")
+    return _json_response(request, encoded, token=token)
 
 
 # Guest chat
+async def _guest_context() -> dict:
+    await _knowledge_ready()
+    context = guest_data_cache.get("context")
+    if not context:
+        raw     = await fetch_guest_data()
+        context = prepare_context(raw, "guest")
+        guest_data_cache.set("data", raw)
+        guest_data_cache.set("context", context)
+    return context
+
+
 @app.post("/guest-chat")
 async def guest_chat(body: GuestChatRequest):
-    global guest_data_cache
-    if not guest_data_cache:
-        guest_data_cache = await fetch_guest_data()
-    filtered = filter_data_for_role(guest_data_cache, "guest")
-    prompt   = build_ai_context(filtered, body.message)
-    reply    = ask_ai(prompt)
+    context = await _guest_context()
+    reply   = direct_answer(context, body.message) or await ask_ai(
+        build_ai_context(context, body.message), scope="guest",
+        question=body.message, fingerprint=context["fingerprint"], priority=PRIORITY_GUEST,
+    )
     return {"reply": reply, "role": "guest"}
 
 
+@app.post("/guest-chat/stream")
+async def guest_chat_stream(body: GuestChatRequest):
+    context = await _guest_context()
+    reply   = direct_answer(context, body.message)
+    chunks  = _single_chunk(reply) if reply else stream_ai(
+        build_ai_context(context, body.message), scope="guest",
+        question=body.message, fingerprint=context["fingerprint"], priority=PRIORITY_GUEST,
+    )
+    return _sse_response(chunks, "guest")
+
+
 # Authenticated chat 
-@app.post("/chat")
-async def chat(body: ChatRequest):
+async def _user_context(body: ChatRequest) -> tuple[dict, dict]:
     session = get_session(body.token)
     if not session:
         raise HTTPException(401, detail="Session expired. Please log in again.")
+    await _knowledge_ready()
+
+    context = context_cache.get(body.token)
+    if not context:
+        cached  = await _session_data(body.token, session)
+        context = context_cache.get(body.token)
+        if not context:
+            raw     = payload.loads(cached["body"])["data"]
+            context = _store_data(body.token, raw, session["role"])[1]
+
+    return session, context
+
+
+def _cache_scope(session: dict) -> str:
+    return f"{session['role']}:{session['username']}"
+
+
+def _answer_question(body: ChatRequest, history: dict) -> str | None:
+    # a follow-up ("why?", "and for sem 3?") means something else in every
+    # conversation, so it skips the question-keyed cache; a question with a
+    # topic of its own may still be answered from it
+    if history["turns"] and detect_intent(body.message) == "general":
+        return None
+    return body.message
+
+
+def _save_turn(body: ChatRequest):
+    # only model answers join the history: direct tables and busy or error
+    # replies would only crowd out the exchanges worth following up on
+    return lambda reply: save_turn(body.token, body.message, reply)
 
-    raw_data = data_cache.get(body.token)
-    if not raw_data:
+
+@app.post("/chat")
+async def chat(body: ChatRequest):
+    session, context = await _user_context(body)
+    history = get_conversation(body.token)
+    reply   = direct_answer(context, body.message) or await ask_ai(
+        build_ai_context(context, body.message, history=history), scope=_cache_scope(session),
+        question=_answer_question(body, history), fingerprint=context["fingerprint"],
+        on_answer=_save_turn(body),
+    )
+    return {"reply": reply, "role": session["role"]}
+
+
+@app.post("/chat/stream")
+async def chat_stream(body: ChatRequest):
+    session, context = await _user_context(body)
+    history = get_conversation(body.token)
+    reply   = direct_answer(context, body.message)
+    chunks  = _single_chunk(reply) if reply else stream_ai(
+        build_ai_context(context, body.message, history=history), scope=_cache_scope(session),
+        question=_answer_question(body, history), fingerprint=context["fingerprint"],
+        on_answer=_save_turn(body),
+    )
+    return _sse_response(chunks, session["role"])
+
+
+async def _single_chunk(text: str):
+    yield text
+
+
+# Server-Sent Events: one "data" event per text chunk, then "done"
+def _sse_response(chunks, role: str) -> StreamingResponse:
+    async def events():
         try:
-            if session["role"] == "faculty":
-                raw_data = await fetch_faculty_data(session["username"], session["password"])
-            else:
-                raw_data = await fetch_student_data(session["username"], session["password"])
-            data_cache[body.token] = raw_data
+            async for text in chunks:
+                yield f"data: {json.dumps({'text': text})}\n\n"
         except Exception as e:
-            raise HTTPException(500, detail=_clean_error(str(e)))
+            yield f"event: error\ndata: {json.dumps({'detail': f'AI error: {e}'})}\n\n"
+        yield f"event: done\ndata: {json.dumps({'role': role})}\n\n"
 
-    filtered = filter_data_for_role(raw_data, session["role"])
-    prompt   = build_ai_context(filtered, body.message)
-    reply    = ask_ai(prompt)
-    return {"reply": reply, "role": session["role"]}
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 #logout 
 @app.post("/logout")
 async def logout(body: LogoutRequest):
+    session = get_session(body.token)
     delete_session(body.token)
-    data_cache.pop(body.token, None)
+    # keep the pooled portal client while another session logged in with it
+    if session and not credentials_in_use(session["username"], session["password"]):
+        await release_user(session["username"], session["password"])
+    data_cache.delete(body.token)
+    context_cache.delete(body.token)
     return {"message": "Logged out successfully"}
 
 
 # Static files
-app.mount("/", StaticFiles(directory="frontend", html=True), name="static")
\ No newline at end of file
+class CachedStaticFiles(StaticFiles):
+    """
+    Pages are revalidated on every load (ETag / Last-Modified -> 304);
+    assets referenced with a content fingerprint (`app.js?v=<hash>`) are
+    cached for a year, anything else for an hour.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if str(full_path).endswith(".html"):
+            response.headers["Cache-Control"] = "no-cache"
+        elif b"v=" in scope.get("query_string", b""):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
+
+app.mount("/", CachedStaticFiles(directory="frontend", html=True), name="static")
\ No newline at end of file
@@ -0,0 +1,238 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import os
+import time
+
+# Spans are emitted only when OpenTelemetry is installed and configured
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("pesu-reimagined")
+except ImportError:
+    _tracer = None
+
+SLOW_REQUEST = float(os.getenv("SLOW_REQUEST_SECONDS", "5"))   # requests at least this slow are logged with their stages
+
+# Seconds, from cache hits to a slow Gemini call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Prompt characters, around CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN
+SIZE_BUCKETS    = (500, 1000, 2000, 4000, 8000, 12000, 16000, 24000, 32000, 64000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Monotonic count per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name   = name
+        self.help   = help
+        self.series: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels(k)} {_number(v)}" for k, v in sorted(self.series.items())]
+
+
+class Gauge(Counter):
+    """Value set at scrape time by a collector; `kind` may be "counter" for totals kept elsewhere."""
+
+    def __init__(self, name: str, help: str, kind: str = "gauge"):
+        super().__init__(name, help)
+        self.kind = kind
+
+    def set(self, value: float, **labels) -> None:
+        self.series[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """Bucketed observations per label set, rendered cumulatively as Prometheus expects."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name    = name
+        self.help    = help
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}   # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key    = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, series in sorted(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = bound if bound == "+Inf" else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', le),))} {total}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(key)} {total}")
+        return lines
+
+
+_metrics: dict[str, Counter | Histogram] = {}
+_collectors: list = []
+
+
+def _register(metric):
+    return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter(name, help))
+
+
+def gauge(name: str, help: str, kind: str = "gauge") -> Gauge:
+    return _register(Gauge(name, help, kind))
+
+
+def histogram(name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, buckets))
+
+
+def collector(fn):
+    """Register `fn()` to refresh gauges just before each scrape."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"[METRICS] Collector {fn.__name__} failed: {e}")
+    lines = []
+    for metric in _metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = histogram("pesu_request_seconds", "HTTP request latency by route, method and status.")
+STAGE_SECONDS   = histogram("pesu_stage_seconds", "Latency of one stage of a request: portal calls, RAG, prompt build, LLM.")
+LLM_SECONDS     = histogram("pesu_llm_call_seconds", "Latency of one Gemini attempt by key and outcome.")
+PROMPT_CHARS    = histogram("pesu_prompt_chars", "Size of the prompts sent to Gemini.", SIZE_BUCKETS)
+LLM_CALLS       = counter("pesu_llm_calls_total", "Gemini attempts by key and outcome.")
+LLM_TOKENS      = counter("pesu_llm_tokens_total", "Tokens Gemini reported as used, by key.")
+LLM_RETRIES     = counter("pesu_llm_retries_total", "Gemini attempts retried on another key.")
+CONTEXT_CACHES  = counter("pesu_llm_context_cache_total", "Gemini context cache use: hit, inline, created, refreshed, failed, dropped.")
+REPLIES         = counter("pesu_replies_total", "Chat replies by source: direct, answer_cache, response_cache, llm, shed, error.")
+
+
+# ── Per-request breakdown ──────────────────────────────────────────────────────
+# RequestMetrics puts a record in this context variable; stage() and note()
+# fill it in from anywhere below the endpoint, including tasks it starts.
+_request: contextvars.ContextVar[dict | None] = contextvars.ContextVar("pesu_request", default=None)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a block as stage `name`: histogram, the request's breakdown and a trace span."""
+    span  = _tracer.start_as_current_span(name) if _tracer else contextlib.nullcontext()
+    start = time.perf_counter()
+    try:
+        with span:
+            yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """Add `seconds` to stage `name`, for stages that do not fit a with-block."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    record = _request.get()
+    if record is not None:
+        record["stages"][name] = record["stages"].get(name, 0.0) + seconds
+
+
+def timed(name: str):
+    """Decorator form of stage() for plain functions."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def note(**fields) -> None:
+    """Attach facts (key used, retries, prompt size) to the current request's slow-request log."""
+    record = _request.get()
+    if record is not None:
+        record["notes"].update(fields)
+
+
+def _server_timing(stages: dict) -> bytes:
+    return ", ".join(f"{name};dur={1000 * secs:.1f}" for name, secs in stages.items()).encode()
+
+
+class RequestMetrics:
+    """
+    ASGI middleware: times every HTTP request by route, adds a
+    Server-Timing header with the stages finished before the response
+    started, and logs requests slower than SLOW_REQUEST with their
+    stages and notes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        record = {"stages": {}, "notes": {}}
+        token  = _request.set(record)
+        start  = time.perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if record["stages"]:
+                    headers = list(message.get("headers", [])) + [(b"server-timing", _server_timing(record["stages"]))]
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _request.reset(token)
+            elapsed = time.perf_counter() - start
+            # the matched route template keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "static"
+            REQUEST_SECONDS.observe(elapsed, route=route, method=scope["method"], status=status)
+            if elapsed >= SLOW_REQUEST:
+                stages = " ".join(f"{n}={s:.2f}s" for n, s in record["stages"].items())
+                notes  = " ".join(f"{k}={v}" for k, v in record["notes"].items())
+                print(f"[METRICS] Slow {scope['method']} {route} {status} in {elapsed:.2f}s: {stages} {notes}".rstrip())
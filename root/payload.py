@@ -0,0 +1,41 @@
+import gzip
+import hashlib
+import json
+
+try:
+    import orjson
+except ImportError:   # falls back to the stdlib encoder
+    orjson = None
+
+GZIP_LEVEL     = 6
+MIN_GZIP_BYTES = 1024   # smaller bodies are sent uncompressed
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(blob: bytes):
+    return orjson.loads(blob) if orjson is not None else json.loads(blob)
+
+
+def encode(obj, version=None) -> dict:
+    """
+    Encode a response body once so it can be served many times:
+    {"version", "body", "gzip", "etag"}. "gzip" is None for small bodies.
+    """
+    body = dumps(obj)
+    return {
+        "version": version,
+        "body":    body,
+        "gzip":    gzip.compress(body, GZIP_LEVEL, mtime=0) if len(body) >= MIN_GZIP_BYTES else None,
+        "etag":    '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+    }
+
+
+def with_fields(payload: dict, **fields) -> bytes:
+    """The payload's JSON object body with extra top-level fields spliced in."""
+    extra = b"".join(dumps(k) + b":" + dumps(v) + b"," for k, v in fields.items())
+    return b"{" + extra + payload["body"][1:]
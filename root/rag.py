@@ -1,14 +1,74 @@
-
-
+import functools
+import hashlib
+import heapq
+import json
 import math
+import mmap
+import os
 import re
-from collections import Counter
+import struct
+import sys
+import tempfile
+from array import array
+from collections import Counter, defaultdict
 from pathlib import Path
 
+from metrics import timed
+
+# numpy / scipy are only needed by retrieve_many(), so they are imported on
+# its first call rather than with the app; None until then or if missing
+np     = None
+sparse = None
+_numeric_checked = False
+
+
+def _numeric() -> bool:
+    global np, sparse, _numeric_checked
+    if not _numeric_checked:
+        _numeric_checked = True
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError:   # batch scoring falls back to per-query retrieve()
+            np = sparse = None
+    return sparse is not None
+
 KNOWLEDGE_DIR = Path("knowledge")
+# RAG_INDEX_DIR moves the index off a read-only knowledge/; if it cannot be
+# written either, load_knowledge() falls back to _fallback_index_dir()
+INDEX_DIR     = Path(os.getenv("RAG_INDEX_DIR") or KNOWLEDGE_DIR / ".index")
+INDEX_PATH    = INDEX_DIR / "rag.idx"
+SEGMENT_DIR   = INDEX_DIR / "segments"
+
+# Compiled index file layout:
+#   b"PESURAG1" | u64 meta length | meta JSON | padding to 8 | arrays
+# meta["arrays"][name] = [offset from data start, byte length]
+_MAGIC         = b"PESURAG1"
+INDEX_VERSION  = 3   # bumped when compiling changes, so older indexes are rebuilt
+_ARRAY_TYPES   = {
+    "post_ids":  "i",   # chunk id per posting, grouped by term
+    "post_w":    "f",   # tf-idf weight / chunk norm per posting
+    "text_off":  "q",   # n_chunks + 1 byte offsets into "text"
+    "chunk_src": "i",   # index into meta["sources"] per chunk
+    "text":      "B",   # utf-8 chunk texts, back to back
+}
+
+# Views over the memory-mapped index; populated by load_knowledge()
+_mm        = None
+_arrays: dict[str, memoryview] = {}
+_sources: list[str] = []
+_n_chunks  = 0
+
+# term -> (first posting, posting count, idf); unseen terms use _idf_default
+_terms: dict[str, tuple[int, int, float]] = {}
+_idf_default = 1.0
+
+# term x chunk CSR matrix over the mapped postings, i.e. the normalised
+# chunk TF-IDF vectors as columns. Built lazily by retrieve_many().
+_matrix = None
 
-# Each chunk: {"text": str, "source": str, "tf": Counter, "norm": float}
-_chunks: list[dict] = []
+# Every chunk formatted for a prompt prefix. Built lazily by full_text().
+_full_text = None
 
 _STOP = {
     "a","an","the","is","are","was","were","be","been","being",
@@ -19,10 +79,21 @@ _STOP = {
     "i","we","you","he","she","they","their","our","your","his","her",
 }
 
-CHUNK_SIZE  = 200   # words per chunk
-CHUNK_STEP  = 150   # step between chunk starts (50-word overlap)
-TOP_K       = 3     # chunks returned per query
-MIN_SCORE   = 1     # minimum keyword hits to be included
+CHUNK_SIZE      = 120   # max words per chunk; a longer single sentence stays whole
+MIN_CHUNK_WORDS = 30    # a heading starts a new chunk once the current one has this many
+DEDUP_DISTANCE  = 3     # SimHash bits within which two chunks are compared for duplication
+TOP_K           = 3     # chunks returned per query
+MIN_SCORE       = 1     # minimum keyword hits to be included
+
+# A question is answered straight from one passage (no LLM) only when the
+# best chunk clearly wins and one of its sentences covers the question
+FAQ_MIN_SCORE    = 0.15   # cosine of the best chunk
+FAQ_MIN_MARGIN   = 1.3    # best chunk score / best score from any other source
+FAQ_MIN_COVERAGE = 0.8    # share of the question's term weight inside the sentence
+_QUESTION_WORDS  = {
+    "what", "whats", "how", "who", "whom", "when", "where", "which", "why",
+    "tell", "explain", "please", "pls", "many", "much", "there", "me",
+}
 
 
 def _tokenise(text: str) -> list[str]:
@@ -31,110 +102,561 @@ def _tokenise(text: str) -> list[str]:
     return [t for t in tokens if t not in _STOP and len(t) > 1]
 
 
-def _tfidf_norm(tf: Counter, n_docs: int, df: dict) -> float:
-    """Pre-compute L2 norm of the TF-IDF vector for cosine similarity."""
-    total = 0.0
-    for term, count in tf.items():
-        idf = math.log((n_docs + 1) / (df.get(term, 0) + 1)) + 1
-        total += (count * idf) ** 2
-    return math.sqrt(total) or 1.0
+# Words that reverse a question; _STOP drops "not" and "no" from _tokenise
+_NEGATIONS = {
+    "not","no","never","none","nor","neither","without","cannot","cant","dont",
+    "doesnt","didnt","isnt","arent","wasnt","werent","wont","shouldnt","mustnt",
+}
+
+
+def _words(text: str) -> list[str]:
+    """Lowercase words in order without punctuation, nothing dropped ("don't" -> "dont")."""
+    return re.findall(r"[a-z0-9]+", re.sub(r"['\u2019]", "", text.lower()))
+
+
+# ── Chunking ───────────────────────────────────────────────────────────────────
+
+_SENTENCE_END = re.compile(rb"(?<=[.!?])\s+")
+
+
+def _is_heading(line: str) -> bool:
+    """Markdown headings and short title lines without sentence punctuation."""
+    if line.startswith("#"):
+        return True
+    return len(line.split()) <= 8 and line[0].isupper() and line[-1] not in ".!?:;,"
+
+
+def _sentences(line: bytes, offset: int):
+    """(start, end) byte spans of the sentences in one line starting at `offset`."""
+    start = len(line) - len(line.lstrip())
+    end   = len(line.rstrip())
+    for match in _SENTENCE_END.finditer(line, start, end):
+        yield offset + start, offset + match.start()
+        start = match.end()
+    if start < end:
+        yield offset + start, offset + end
+
+
+def _chunk_file(path: Path, digest) -> list[list]:
+    """
+    Stream `path` line by line (feeding `digest`) and return its chunks as
+    [start, end, tf, words] byte spans. Sentences are packed up to
+    CHUNK_SIZE words and never split, a heading starts a new chunk once the
+    current one has MIN_CHUNK_WORDS, and a short tail joins the chunk before.
+    """
+    chunks, current, offset = [], None, 0
+    with open(path, "rb") as f:
+        for line in f:
+            digest.update(line)
+            text = line.strip().decode("utf-8", errors="ignore")
+            if text:
+                if current and current[3] >= MIN_CHUNK_WORDS and _is_heading(text):
+                    current = None
+                for start, end in _sentences(line, offset):
+                    sentence = line[start - offset : end - offset].decode("utf-8", errors="ignore")
+                    words    = len(sentence.split())
+                    if current and current[3] + words > CHUNK_SIZE:
+                        current = None
+                    if current is None:
+                        current = [start, end, Counter(), 0]
+                        chunks.append(current)
+                    current[1]  = end
+                    current[2].update(_tokenise(sentence))
+                    current[3] += words
+            offset += len(line)
+
+    if len(chunks) > 1 and chunks[-1][3] < MIN_CHUNK_WORDS:
+        tail = chunks.pop()
+        chunks[-1][1] = tail[1]
+        chunks[-1][2].update(tail[2])
+        chunks[-1][3] += tail[3]
+    return chunks
+
+
+@functools.lru_cache(maxsize=65536)
+def _spread(term: str) -> int:
+    """The term's 64-bit hash with each bit widened into its own 32-bit lane."""
+    h = int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little")
+    return sum(1 << (32 * bit) for bit in range(64) if h >> bit & 1)
+
+
+def _simhash(tf: dict[str, int]) -> int:
+    """
+    64-bit SimHash of a chunk's term counts; near-identical chunks differ
+    in few bits. All 64 per-bit tallies are summed at once as lanes of one int.
+    """
+    total = sum(tf.values())
+    lanes = sum(count * _spread(term) for term, count in tf.items())
+    mask  = (1 << 32) - 1
+    return sum(1 << bit for bit in range(64) if 2 * (lanes >> (32 * bit) & mask) > total)
+
+
+def _read_span(f, start: int, end: int) -> str:
+    """A chunk's text from its byte span, one trimmed line per source line."""
+    f.seek(start)
+    text = f.read(end - start).decode("utf-8", errors="ignore")
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+# ── Per-file segments (incremental rebuild cache) ──────────────────────────────
+
+def _segment(path: Path) -> tuple[dict, bool]:
+    """
+    Return (segment, rebuilt) for one knowledge file. A segment holds the
+    file's chunks as byte spans with term counts and a SimHash; it is
+    re-read from SEGMENT_DIR when the file's mtime/size or content hash is
+    unchanged. Files are streamed, never read whole.
+    """
+    st       = path.stat()
+    seg_path = SEGMENT_DIR / f"{path.name}.json"
+    cached   = None
+    try:
+        cached = json.loads(seg_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+
+    if cached and cached.get("chunker") == _chunker_id() and (
+        cached.get("mtime_ns") == st.st_mtime_ns and cached.get("size") == st.st_size
+    ):
+        return cached, False
+
+    digest = hashlib.sha1()
+    chunks = _chunk_file(path, digest)
+    sha1   = digest.hexdigest()
+    if cached and cached.get("chunker") == _chunker_id() and cached.get("sha1") == sha1:
+        seg = dict(cached, mtime_ns=st.st_mtime_ns, size=st.st_size)
+        _write_atomic(seg_path, json.dumps(seg).encode())
+        return seg, False
+
+    seg = {
+        "chunker":  _chunker_id(),
+        "mtime_ns": st.st_mtime_ns,
+        "size":     st.st_size,
+        "sha1":     sha1,
+        "chunks":   [[start, end, tf, _simhash(tf)] for start, end, tf, _ in chunks],
+    }
+    _write_atomic(seg_path, json.dumps(seg).encode())
+    return seg, True
+
+
+def _chunker_id() -> str:
+    return f"sentences:{CHUNK_SIZE}:{MIN_CHUNK_WORDS}"
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+# ── Compiled index ─────────────────────────────────────────────────────────────
+
+def _compile(files: list[Path], segments: list[dict]) -> int:
+    """
+    Drop duplicate chunks, compute IDF once, normalise postings, and
+    write INDEX_PATH atomically. Returns the number of duplicates dropped.
+    """
+    tfs, texts, chunk_src = [], [], array("i")
+    bands   = defaultdict(list)   # (band, 16-bit value) -> (SimHash, chunk id) of kept chunks
+    dropped = 0
+    for src_id, (path, seg) in enumerate(zip(files, segments)):
+        with open(path, "rb") as f:
+            for start, end, tf, simhash in seg["chunks"]:
+                text = _read_span(f, start, end)
+                # hashes within DEDUP_DISTANCE (< 4) bits agree on at least one 16-bit band
+                keys = [(b, simhash >> (16 * b) & 0xFFFF) for b in range(4)]
+                near = {cid for key in keys for other, cid in bands[key]
+                        if bin(simhash ^ other).count("1") <= DEDUP_DISTANCE}
+                # a close hash only nominates a duplicate: chunks differing by a word or a number stay
+                if near and any(_words(text) == _words(texts[cid].decode("utf-8")) for cid in near):
+                    dropped += 1
+                    continue
+                for key in keys:
+                    bands[key].append((simhash, len(texts)))
+                texts.append(text.encode("utf-8"))
+                tfs.append(tf)
+                chunk_src.append(src_id)
+
+    n  = len(tfs)
+    df = Counter()
+    for tf in tfs:
+        df.update(tf.keys())
+    idf = {term: math.log((n + 1) / (count + 1)) + 1 for term, count in df.items()}
+
+    postings = defaultdict(list)
+    for cid, tf in enumerate(tfs):
+        weights = {term: count * idf[term] for term, count in tf.items()}
+        norm    = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        for term, w in weights.items():
+            postings[term].append((cid, w / norm))
+
+    terms, post_ids, post_w = {}, array("i"), array("f")
+    for term in sorted(postings):
+        terms[term] = [len(post_ids), len(postings[term]), idf[term]]
+        for cid, w in postings[term]:
+            post_ids.append(cid)
+            post_w.append(w)
+
+    text_off = array("q", [0])
+    for raw in texts:
+        text_off.append(text_off[-1] + len(raw))
+
+    blobs = {
+        "post_ids":  post_ids.tobytes(),
+        "post_w":    post_w.tobytes(),
+        "text_off":  text_off.tobytes(),
+        "chunk_src": chunk_src.tobytes(),
+        "text":      b"".join(texts),
+    }
+    layout, offset = {}, 0
+    for name, blob in blobs.items():
+        layout[name] = [offset, len(blob)]
+        offset += _pad(len(blob))
+
+    meta = json.dumps({
+        "version":     INDEX_VERSION,
+        "byteorder":   sys.byteorder,
+        "chunker":     _chunker_id(),
+        "files":       {p.name: {"mtime_ns": s["mtime_ns"], "size": s["size"]}
+                        for p, s in zip(files, segments)},
+        "sources":     [p.stem for p in files],
+        "n_chunks":    n,
+        "idf_default": math.log(n + 1) + 1,
+        "terms":       terms,
+        "arrays":      layout,
+    }).encode()
+
+    header = _MAGIC + struct.pack("<Q", len(meta)) + meta
+    parts  = [header, b"\0" * (_pad(len(header)) - len(header))]
+    for blob in blobs.values():
+        parts += [blob, b"\0" * (_pad(len(blob)) - len(blob))]
+    _write_atomic(INDEX_PATH, b"".join(parts))
+    return dropped
+
+
+def _pad(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _read_meta() -> dict | None:
+    try:
+        with open(INDEX_PATH, "rb") as f:
+            head = f.read(16)
+            if len(head) < 16 or head[:8] != _MAGIC:
+                return None
+            (meta_len,) = struct.unpack("<Q", head[8:])
+            meta = json.loads(f.read(meta_len))
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != INDEX_VERSION or meta.get("byteorder") != sys.byteorder:
+        return None
+    if meta.get("chunker") != _chunker_id():
+        return None
+    meta["data_start"] = _pad(16 + meta_len)
+    return meta
+
+
+def _is_current(meta: dict | None, files: list[Path]) -> bool:
+    if not meta or list(meta["files"]) != [p.name for p in files]:
+        return False
+    for path in files:
+        st     = path.stat()
+        stored = meta["files"][path.name]
+        if stored["mtime_ns"] != st.st_mtime_ns or stored["size"] != st.st_size:
+            return False
+    return True
+
+
+def _open_index(meta: dict) -> None:
+    """Memory-map INDEX_PATH so every worker shares the same page cache."""
+    global _mm, _sources, _n_chunks, _idf_default, _matrix, _full_text
+    with open(INDEX_PATH, "rb") as f:
+        _mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view  = memoryview(_mm)
+    start = meta["data_start"]
+    _arrays.clear()
+    for name, (offset, length) in meta["arrays"].items():
+        _arrays[name] = view[start + offset : start + offset + length].cast(_ARRAY_TYPES[name])
+
+    _terms.clear()
+    _terms.update((term, tuple(entry)) for term, entry in meta["terms"].items())
+    _sources     = meta["sources"]
+    _n_chunks    = meta["n_chunks"]
+    _idf_default = meta["idf_default"]
+    _matrix      = None
+    _full_text   = None
+
+
+def _use_index_dir(path: Path) -> None:
+    global INDEX_DIR, INDEX_PATH, SEGMENT_DIR
+    INDEX_DIR, INDEX_PATH, SEGMENT_DIR = path, path / "rag.idx", path / "segments"
+
+
+def _fallback_index_dir() -> Path:
+    """A temp directory for the index, one per knowledge directory."""
+    tag = hashlib.sha1(str(KNOWLEDGE_DIR.resolve()).encode()).hexdigest()[:12]
+    return Path(tempfile.gettempdir()) / f"pesu-rag-{tag}"
+
+
+def _rebuild(files: list[Path]) -> tuple[int, int]:
+    """Re-chunk changed files and compile INDEX_PATH; (files re-chunked, duplicates dropped)."""
+    segments, rebuilt = [], 0
+    for path in files:
+        seg, changed = _segment(path)
+        segments.append(seg)
+        rebuilt += changed
+
+    live = {f"{p.name}.json" for p in files}
+    for stale in SEGMENT_DIR.glob("*.json"):
+        if stale.name not in live:
+            stale.unlink(missing_ok=True)
+
+    return rebuilt, _compile(files, segments)
 
 
 def load_knowledge() -> int:
     """
-    Load every .txt file in KNOWLEDGE_DIR into memory.
-    Call once at server startup. Returns number of chunks loaded.
+    Open the compiled index for every .txt file in KNOWLEDGE_DIR, rebuilding
+    it first if any file was added, removed or modified since it was written.
+    Only changed files are re-chunked. If INDEX_DIR cannot be written the
+    index is built in a temp directory instead. Returns number of chunks loaded.
     """
-    global _chunks
-    _chunks = []
+    global _mm, _sources, _n_chunks, _matrix, _full_text
+    _mm, _sources, _n_chunks, _matrix, _full_text = None, [], 0, None, None
+    _arrays.clear()
+    _terms.clear()
 
     if not KNOWLEDGE_DIR.exists():
         print(f"[RAG] Warning: knowledge/ directory not found at {KNOWLEDGE_DIR.resolve()}")
         return 0
 
-    raw_chunks = []
-    for path in sorted(KNOWLEDGE_DIR.glob("*.txt")):
-        text  = path.read_text(encoding="utf-8", errors="ignore").strip()
-        words = text.split()
-        for i in range(0, max(1, len(words) - CHUNK_SIZE + 1), CHUNK_STEP):
-            chunk_text = " ".join(words[i : i + CHUNK_SIZE])
-            raw_chunks.append({"text": chunk_text, "source": path.stem})
-
-    # document-frequency table across all chunks
-    df: dict[str, int] = Counter()
-    tfs = []
-    for chunk in raw_chunks:
-        tokens = _tokenise(chunk["text"])
-        tf = Counter(tokens)
-        tfs.append(tf)
-        for term in tf:
-            df[term] += 1
-
-    n = len(raw_chunks)
-    for chunk, tf in zip(raw_chunks, tfs):
-        _chunks.append({
-            "text":   chunk["text"],
-            "source": chunk["source"],
-            "tf":     tf,
-            "norm":   _tfidf_norm(tf, n, df),
-            "df":     df,   # shared reference
-            "n":      n,
-        })
-
-    print(f"[RAG] Loaded {len(_chunks)} chunks from {KNOWLEDGE_DIR.resolve()}")
-    return len(_chunks)
+    files = sorted(KNOWLEDGE_DIR.glob("*.txt"))
+    meta  = _read_meta()
+    if _is_current(meta, files):
+        _open_index(meta)
+        print(f"[RAG] Opened index with {_n_chunks} chunks from {INDEX_PATH.resolve()}")
+        return _n_chunks
+
+    try:
+        rebuilt, dropped = _rebuild(files)
+    except OSError as e:
+        fallback = _fallback_index_dir()
+        if INDEX_DIR == fallback:
+            raise
+        print(f"[RAG] Cannot write the index to {INDEX_DIR.resolve()} ({e}); using {fallback}")
+        _use_index_dir(fallback)
+        return load_knowledge()
+    _open_index(_read_meta())
+    print(f"[RAG] Loaded {_n_chunks} chunks from {KNOWLEDGE_DIR.resolve()} "
+          f"({rebuilt} of {len(files)} files re-chunked, {dropped} duplicates dropped)")
+    return _n_chunks
+
+
+# ── Retrieval ──────────────────────────────────────────────────────────────────
+
+def _query_vector(query: str) -> dict[str, float]:
+    """L2-normalised TF-IDF weights of the query's terms."""
+    q_tf      = Counter(_tokenise(query))
+    q_weights = {}
+    for t, cnt in q_tf.items():
+        entry        = _terms.get(t)
+        q_weights[t] = cnt * (entry[2] if entry else _idf_default)
+    q_norm = math.sqrt(sum(w * w for w in q_weights.values())) or 1.0
+    return {t: w / q_norm for t, w in q_weights.items()}
+
 
+def vectorise(text: str) -> dict[str, float]:
+    """TF-IDF vector of `text` over the loaded vocabulary, L2-normalised."""
+    return _query_vector(text)
 
+
+@timed("rag")
 def retrieve(query: str, top_k: int = TOP_K) -> str:
     """
     Return a formatted string of the most relevant chunks for a query.
     Returns empty string if nothing relevant is found.
     """
-    if not _chunks:
+    if not _n_chunks:
+        return ""
+
+    q_vec = _query_vector(query)
+    if not q_vec:
         return ""
 
-    q_tokens = _tokenise(query)
-    if not q_tokens:
+    threshold = MIN_SCORE / 100   # ~0.01
+    top = heapq.nlargest(
+        top_k,
+        ((dot, cid) for cid, dot in _scores(q_vec).items() if dot >= threshold),
+        key=lambda x: x[0],
+    )
+    if not top:
         return ""
 
-    q_tf   = Counter(q_tokens)
-    df     = _chunks[0]["df"]
-    n      = _chunks[0]["n"]
-
-    # Computing cosine similarity between query and each chunk
-    scored = []
-    for chunk in _chunks:
-        # Dot product
-        dot = 0.0
-        for term, q_count in q_tf.items():
-            if term in chunk["tf"]:
-                idf   = math.log((n + 1) / (df.get(term, 0) + 1)) + 1
-                dot  += q_count * idf * chunk["tf"][term] * idf
-
-        if dot == 0:
+    return _format([cid for _, cid in top])
+
+
+def _scores(q_vec: dict[str, float]) -> dict[int, float]:
+    """Cosine similarity per chunk, accumulated only over postings of the query's terms."""
+    post_ids, post_w = _arrays["post_ids"], _arrays["post_w"]
+    scores: dict[int, float] = defaultdict(float)
+    for term, q_w in q_vec.items():
+        entry = _terms.get(term)
+        if entry is None:
             continue
+        start, count = entry[0], entry[1]
+        for cid, w in zip(post_ids[start : start + count], post_w[start : start + count]):
+            scores[cid] += q_w * w
+    return scores
+
+
+@timed("rag")
+def best_passage(query: str) -> dict | None:
+    """
+    The sentence that answers an FAQ-style `query` with high confidence,
+    as {"source", "text", "score"}, or None when the LLM should answer.
+    """
+    if not _n_chunks:
+        return None
+    # coverage cannot tell "what is allowed" from "what is not allowed"
+    if _NEGATIONS & set(_words(query)):
+        return None
+    q_vec = _query_vector(query)
+    if not q_vec:
+        return None
 
-        # Query norm (computed inline — cheap)
-        q_norm = math.sqrt(sum(
-            (cnt * (math.log((n + 1) / (df.get(t, 0) + 1)) + 1)) ** 2
-            for t, cnt in q_tf.items()
-        )) or 1.0
+    scores = _scores(q_vec)
+    if not scores:
+        return None
+    best_cid = max(scores, key=scores.get)
+    if scores[best_cid] < FAQ_MIN_SCORE:
+        return None
+    # the margin is over other sources; neighbouring chunks of the same file don't compete
+    src    = _arrays["chunk_src"]
+    rival  = max((dot for cid, dot in scores.items() if src[cid] != src[best_cid]), default=0.0)
+    if scores[best_cid] < FAQ_MIN_MARGIN * rival:
+        return None
 
-        score = dot / (q_norm * chunk["norm"])
-        if score >= MIN_SCORE / 100:   # threshold: ~0.01
-            scored.append((score, chunk))
+    # Coverage counts only content words; unknown words still count against it
+    weights = {t: w for t, w in q_vec.items() if t not in _QUESTION_WORDS}
+    total   = sum(weights.values())
+    if not total:
+        return None
 
-    if not scored:
-        return ""
+    source, text = _chunk(best_cid)
+    sentences    = [s for s in re.split(r"(?<=[.!?])\s+|\n+", text) if s.strip()]
+    best, best_cov = None, FAQ_MIN_COVERAGE
+    for i, sentence in enumerate(sentences):
+        terms = set(_tokenise(sentence))
+        cov   = sum(w for t, w in weights.items() if t in terms) / total
+        if cov >= best_cov and (best is None or cov > best_cov):
+            best, best_cov = i, cov
+    if best is None:
+        return None
+
+    answer = sentences[best]
+    if len(answer.split()) < 8 and best + 1 < len(sentences):   # too terse on its own
+        answer += " " + sentences[best + 1]
+    return {"source": source.replace("_", " ").title(), "text": answer, "score": scores[best_cid]}
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = scored[:top_k]
 
+@timed("rag")
+def retrieve_many(queries: list[str], top_k: int = TOP_K) -> list[str]:
+    """
+    Batch version of retrieve() for offline replay and FAQ pre-warming.
+    Scores all queries with one sparse mat-mul when numpy/scipy are
+    installed; otherwise loops over retrieve().
+    """
+    if not _n_chunks:
+        return ["" for _ in queries]
+    if not _numeric():
+        return [retrieve(q, top_k) for q in queries]
+
+    matrix = _term_matrix()
+    cols   = {term: col for col, term in enumerate(_terms)}
+    rows, q_cols, vals = [], [], []
+    for qi, query in enumerate(queries):
+        for term, w in _query_vector(query).items():
+            col = cols.get(term)
+            if col is not None:
+                rows.append(qi)
+                q_cols.append(col)
+                vals.append(w)
+    q_matrix = sparse.csr_matrix(
+        (vals, (rows, q_cols)), shape=(len(queries), len(_terms)), dtype=np.float32,
+    )
+    scores = (q_matrix @ matrix).tocsr()
+
+    results = []
+    threshold = MIN_SCORE / 100
+    for qi in range(len(queries)):
+        start, end = scores.indptr[qi], scores.indptr[qi + 1]
+        row_scores = scores.data[start:end]
+        row_ids    = scores.indices[start:end]
+        keep       = row_scores >= threshold
+        row_scores, row_ids = row_scores[keep], row_ids[keep]
+        if len(row_scores) > top_k:
+            part = np.argpartition(-row_scores, top_k - 1)[:top_k]
+            row_scores, row_ids = row_scores[part], row_ids[part]
+        order = np.argsort(-row_scores, kind="stable")
+        results.append(_format(row_ids[order].tolist()) if len(order) else "")
+    return results
+
+
+def _term_matrix():
+    """
+    Wrap the mapped postings as a term x chunk CSR matrix without copying:
+    postings are already grouped by term, so they are its data/indices.
+    """
+    global _matrix
+    if _matrix is None:
+        indptr = np.fromiter(
+            (entry[0] for entry in _terms.values()), dtype=np.int32, count=len(_terms),
+        )
+        indptr = np.append(indptr, len(_arrays["post_ids"]))
+        _matrix = sparse.csr_matrix(
+            (np.asarray(_arrays["post_w"]), np.asarray(_arrays["post_ids"]), indptr),
+            shape=(len(_terms), _n_chunks),
+        )
+    return _matrix
+
+
+def _chunk(cid: int) -> tuple[str, str]:
+    """(source stem, text) of a chunk, decoded from the mapped text blob."""
+    text_off = _arrays["text_off"]
+    raw      = _arrays["text"][text_off[cid] : text_off[cid + 1]]
+    return _sources[_arrays["chunk_src"][cid]], bytes(raw).decode("utf-8")
+
+
+def _format(chunk_ids: list[int]) -> str:
     parts = []
-    for _, chunk in top:
-        parts.append(f"[Source: {chunk['source'].replace('_', ' ').title()}]\n{chunk['text']}")
+    for cid in chunk_ids:
+        source, text = _chunk(cid)
+        parts.append(f"[Source: {source.replace('_', ' ').title()}]\n{text}")
     return "\n\n".join(parts)
 
 
+def full_text(max_chars: int) -> str | None:
+    """
+    The whole knowledge base, grouped by source, for prompts that carry
+    all of it instead of retrieved chunks; None if nothing is loaded or it
+    is longer than `max_chars`.
+    """
+    global _full_text
+    if not _n_chunks or len(_arrays["text"]) > max_chars:
+        return None
+    if _full_text is None:
+        parts, last = [], None
+        for cid in range(_n_chunks):
+            source, text = _chunk(cid)
+            if source != last:
+                parts.append(f"[Source: {source.replace('_', ' ').title()}]")
+                last = source
+            parts.append(text)
+        _full_text = "\n\n".join(parts)
+    return _full_text
+
+
 def is_loaded() -> bool:
-    return len(_chunks) > 0
\ No newline at end of file
+    return _n_chunks > 0
@@ -1,5 +1,10 @@
+import hashlib
 import json
-from rag import retrieve
+import os
+import re
+import conversation
+from metrics import REPLIES, timed
+from rag import best_passage, full_text, retrieve, _tokenise, _words
 
 
 def filter_data_for_role(raw_data: dict, role: str) -> dict:
@@ -36,6 +41,12 @@ def filter_data_for_role(raw_data: dict, role: str) -> dict:
 
 
 
+def data_fingerprint(filtered: dict) -> str:
+    """Stable hash of the role-filtered data, used to scope the answer cache."""
+    blob = json.dumps(filtered, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+
 _PERSONAS = {
     "student": (
         "You are PESU Reimagined, a smart academic assistant for PES University students. "
@@ -71,35 +82,359 @@ _PERSONAS = {
 }
 
 
-def build_ai_context(filtered: dict, user_msg: str) -> str:
-    role    = filtered.get("role", "unknown")
-    persona = _PERSONAS.get(role, "You are PESU Reimagined, a PES University academic assistant.")
+# Rough budget for the data + knowledge sections of a prompt (~4 chars/token)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CHARS_PER_TOKEN      = 4
+MIN_TRUNCATED_CHARS  = 200   # don't bother including a section cut shorter than this
+
+_INTENT_WORDS = {
+    "attendance": {
+        "attendance", "attend", "attended", "bunk", "absent", "present", "percentage",
+        "debar", "debarred", "debarment", "shortage", "risk", "condonation",
+    },
+    "timetable": {
+        "timetable", "schedule", "class", "classes", "lecture", "lectures", "slot",
+        "period", "today", "tomorrow", "monday", "tuesday", "wednesday", "thursday",
+        "friday", "saturday", "session", "sessions", "teach", "teaching", "load",
+    },
+    "policy": {
+        "policy", "policies", "rule", "rules", "hostel", "curfew", "exam", "exams",
+        "esa", "isa", "cia", "malpractice", "scholarship", "scholarships", "fee",
+        "fees", "club", "clubs", "fest", "fests", "department", "faculty", "leave",
+    },
+    "profile": {
+        "profile", "name", "srn", "prn", "branch", "program", "programme", "section",
+        "semester", "email", "phone", "campus", "cgpa",
+    },
+}
+
+# Most useful section first for each intent; lower ones are trimmed first
+_SECTION_PRIORITY = {
+    "attendance": ["attendance", "profile", "public_info", "knowledge", "section_info", "timetable"],
+    "timetable":  ["timetable", "section_info", "profile", "knowledge", "public_info", "attendance"],
+    "policy":     ["knowledge", "public_info", "profile", "attendance", "section_info", "timetable"],
+    "profile":    ["profile", "section_info", "attendance", "public_info", "knowledge", "timetable"],
+    "general":    ["profile", "attendance", "public_info", "knowledge", "timetable", "section_info"],
+}
 
-    data = dict(filtered)
-    if "attendance" in data and isinstance(data["attendance"], dict) and data["attendance"]:
-        try:
-            latest = str(max(data["attendance"].keys(), key=int))
-            data["attendance"] = {latest: data["attendance"][latest]}
-        except Exception:
-            pass
+_SECTION_TITLES = {
+    "profile":      "PROFILE",
+    "attendance":   "ATTENDANCE (latest semester; course | attended/total | %)",
+    "timetable":    "TIMETABLE",
+    "section_info": "CLASS SECTION",
+    "public_info":  "PUBLIC PESU INFO",
+    "knowledge":    "STATIC KNOWLEDGE BASE (use this to answer institutional questions)",
+}
 
-    data_str = json.dumps(data, indent=2, default=str)
+# Profile blocks that never help answer academic questions
+_PROFILE_DROP = {"address", "parents", "qualifying_exam"}
+
+
+def detect_intent(user_msg: str) -> str:
+    """Classify a question as attendance / timetable / policy / profile / general."""
+    tokens = set(_tokenise(user_msg))
+    best, best_hits = "general", 0
+    for intent, words in _INTENT_WORDS.items():
+        hits = len(tokens & words)
+        if hits > best_hits:
+            best, best_hits = intent, hits
+    return best
+
+
+def _flatten(value, prefix: str = "") -> list[str]:
+    """`key.sub: value` lines for every non-empty scalar in a nested structure."""
+    if isinstance(value, dict):
+        lines = []
+        for k, v in value.items():
+            lines += _flatten(v, f"{prefix}.{k}" if prefix else str(k))
+        return lines
+    if isinstance(value, list):
+        if all(not isinstance(v, (dict, list)) for v in value):
+            items = [str(v) for v in value if v not in (None, "")]
+            return [f"{prefix}: {', '.join(items)}"] if items else []
+        lines = []
+        for i, v in enumerate(value):
+            lines += _flatten(v, f"{prefix}[{i}]")
+        return lines
+    if value is None or value == "":
+        return []
+    return [f"{prefix}: {value}"]
+
+
+def _latest_semester(attendance) -> tuple[str, list]:
+    if not isinstance(attendance, dict) or not attendance:
+        return "", []
+    try:
+        latest = str(max(attendance.keys(), key=int))
+    except Exception:
+        latest = next(iter(attendance))
+    return latest, attendance.get(latest) or []
+
+
+def _course_row(course) -> str:
+    if not isinstance(course, dict):
+        return str(course)
+    att = course.get("attendance")
+    if isinstance(att, dict):
+        name = " ".join(str(course[k]) for k in ("code", "title") if course.get(k))
+        pct  = att.get("percentage")
+        return (
+            f"{name or '?'} | {att.get('attended', '?')}/{att.get('total', '?')} | "
+            f"{pct if pct is not None else '?'}"
+        )
+    return "; ".join(_flatten(course))
+
+
+def _serialize_attendance(attendance) -> str:
+    semester, courses = _latest_semester(attendance)
+    if not courses:
+        return ""
+    return f"Semester {semester}\n" + "\n".join(_course_row(c) for c in courses)
+
+
+def _serialize_timetable(timetable) -> str:
+    if not isinstance(timetable, dict) or not timetable:
+        return ""
+    schedule = timetable.get("schedule", timetable)
+    if not isinstance(schedule, dict):
+        return "\n".join(_flatten(timetable))
+
+    lines = []
+    for day, slots in schedule.items():
+        if not isinstance(slots, list):
+            lines += _flatten(slots, str(day))
+            continue
+        cells = []
+        for slot in slots:
+            if isinstance(slot, dict):
+                cell = " ".join(str(v) for v in slot.values() if v not in (None, "", [], {}))
+            else:
+                cell = str(slot)
+            if cell:
+                cells.append(cell)
+        if cells:
+            lines.append(f"{day}: " + "; ".join(cells))
+    return "\n".join(lines)
+
+
+def _serialize_profile(profile) -> str:
+    if not isinstance(profile, dict):
+        return ""
+    kept = {k: v for k, v in profile.items() if k not in _PROFILE_DROP}
+    return "\n".join(_flatten(kept))
+
+
+def serialize_sections(filtered: dict) -> dict[str, str]:
+    """Compact text for each data section present in a role-filtered dict."""
+    sections = {
+        "profile":      _serialize_profile(filtered.get("profile")),
+        "attendance":   _serialize_attendance(filtered.get("attendance")),
+        "timetable":    _serialize_timetable(filtered.get("timetable")),
+        "section_info": "\n".join(_flatten(filtered.get("section_info") or {})),
+        "public_info":  "\n".join(_flatten(filtered.get("public_info") or {})),
+    }
+    return {name: text for name, text in sections.items() if text}
+
+
+def _fit_budget(sections: dict[str, str], order: list[str], budget_tokens: int) -> str:
+    """Join sections in priority order, cutting or dropping what exceeds the budget."""
+    remaining = budget_tokens * CHARS_PER_TOKEN
+    blocks    = []
+    for name in order:
+        text = sections.get(name)
+        if not text:
+            continue
+        if len(text) > remaining:
+            if remaining < MIN_TRUNCATED_CHARS:
+                continue
+            cut = text.rfind("\n", 0, remaining)
+            if cut < remaining // 2:   # keep most of a long line rather than drop it
+                cut = text.rfind(" ", 0, remaining)
+            text = text[: cut if cut > 0 else remaining] + " …(truncated)"
+        blocks.append(f"{_SECTION_TITLES[name]}:\n{text}")
+        remaining -= len(text)
+    return "\n\n".join(blocks)
+
+
+def prepare_context(raw_data: dict, role: str) -> dict:
+    """
+    Role-filter and serialise a user's data once, when it enters the cache.
+    Per-message work in build_ai_context is then retrieval plus assembly.
+    """
+    filtered = filter_data_for_role(raw_data, role)
+    return {
+        "role":        filtered.get("role", "unknown"),
+        "username":    filtered.get("username"),
+        "sections":    serialize_sections(filtered),
+        "fingerprint": data_fingerprint(filtered),
+    }
 
-    rag_block = retrieve(user_msg)
-    rag_section = (
-        f"\n\nSTATIC KNOWLEDGE BASE (use this to answer institutional questions):\n{rag_block}"
-        if rag_block else ""
-    )
 
+# ── Prompt prefix ──────────────────────────────────────────────────────────────
+# Everything before "USER ROLE" is the same for every message of a role: the
+# persona and the rules. A prompt goes out in one of two forms: "text", the
+# prefix plus retrieved knowledge chunks within CONTEXT_TOKEN_BUDGET, or,
+# while the whole knowledge base fits, "rest" sent against a Gemini context
+# cache holding "prefix" (persona, rules and the whole knowledge base).
+# ai_handler uses the second form only on a key whose cache is live.
+CONTEXT_CACHE           = os.getenv("GEMINI_CONTEXT_CACHE", "1") != "0"
+PREFIX_KNOWLEDGE_TOKENS = int(os.getenv("PREFIX_KNOWLEDGE_TOKENS", "16000"))   # larger corpora use retrieval only
+
+_DEFAULT_PERSONA = "You are PESU Reimagined, a PES University academic assistant."
+_RULES = (
+    "RULES:\n"
+    "- Use ONLY the personal data and knowledge base provided. Never invent.\n"
+    "- If something is missing say: \'I do not have that information.\'\n"
+    "- Attendance rows are: course code and title | classes attended/total | percentage.\n\n"
+)
+
+
+def prompt_prefix(role: str | None) -> str:
+    """The static start of every prompt for `role`."""
+    return f"{_PERSONAS.get(role, _DEFAULT_PERSONA)}\n\n{_RULES}"
+
+
+def cache_prefix(role: str | None) -> str:
+    """prompt_prefix() plus the whole knowledge base, or "" when caching is off or it does not fit."""
+    knowledge = full_text(PREFIX_KNOWLEDGE_TOKENS * CHARS_PER_TOKEN) if CONTEXT_CACHE else None
+    if not knowledge:
+        return ""
+    return f"{prompt_prefix(role)}{_SECTION_TITLES['knowledge']}:\n{knowledge}\n\n"
+
+
+def _prompt_rest(context: dict, data: str, convo: str, user_msg: str) -> str:
+    user = f"USER: {context['username']}\n" if context.get("username") else ""
     return (
-        f"{persona}\n\n"
-        "RULES:\n"
-        "- Use ONLY the personal data and knowledge base provided. Never invent.\n"
-        "- If something is missing say: \'I do not have that information.\'\n"
-        "- Read all keys in each course object to find subject name and percentage.\n\n"
-        f"USER ROLE: {role}\n\n"
-        f"PERSONAL DATA:\n{data_str}"
-        f"{rag_section}\n\n"
+        f"USER ROLE: {context.get('role', 'unknown')}\n"
+        f"{user}\n"
+        f"{data or 'No data available.'}\n\n"
+        f"{convo}"
         f"QUESTION: {user_msg}\n\n"
         "Answer helpfully and concisely. Use markdown."
-    )
\ No newline at end of file
+    )
+
+
+@timed("prompt_build")
+def build_ai_context(
+    context: dict, user_msg: str, budget_tokens: int = CONTEXT_TOKEN_BUDGET, history: dict | None = None,
+) -> dict:
+    """
+    Assemble the prompt from a prepare_context() result and the question:
+    {"text": prompt_prefix() + data with retrieved knowledge + question,
+    "prefix": cache_prefix() or "", "rest": what follows "prefix" when it is
+    cached}. With a conversation `history`, a follow-up is classified and
+    retrieved for together with the previous question, and the bounded
+    conversation block goes between the data and the question.
+    """
+    role     = context.get("role", "unknown")
+    previous = conversation.last_question(history)
+    intent   = detect_intent(user_msg)
+    if intent == "general" and previous:
+        intent = detect_intent(previous)
+    order = _SECTION_PRIORITY[intent]
+    convo = conversation.render(history)
+    convo = f"{convo}\n\n" if convo else ""
+
+    sections  = dict(context["sections"])
+    rag_block = retrieve(f"{previous} {user_msg}" if previous else user_msg)
+    if rag_block:
+        sections["knowledge"] = rag_block
+    text = prompt_prefix(role) + _prompt_rest(context, _fit_budget(sections, order, budget_tokens), convo, user_msg)
+
+    prefix = cache_prefix(role)
+    rest   = ""
+    if prefix:   # the knowledge base is cached with the prefix, so only the user's data follows it
+        rest = _prompt_rest(context, _fit_budget(context["sections"], order, budget_tokens), convo, user_msg)
+    return {"text": text, "prefix": prefix, "rest": rest}
+
+
+# ── Direct answers ─────────────────────────────────────────────────────────────
+# Questions answered without the LLM: a request for the attendance table made
+# only of these words, or an impersonal FAQ with a high-confidence passage.
+DIRECT_ANSWERS = os.getenv("DIRECT_ANSWERS", "1") != "0"
+
+_TABLE_WORDS = {
+    "attendance", "my", "me", "show", "give", "display", "list", "table", "view",
+    "see", "check", "get", "current", "all", "overall", "summary", "full", "details",
+    "subject", "subjects", "course", "courses", "wise", "each", "per", "percentage",
+    "percentages", "now", "what", "whats", "how", "much", "please", "pls",
+}
+_PERSONAL_WORDS = {"i", "i'm", "im", "me", "my", "mine", "myself", "am"}
+# The prepared context holds only the latest semester, so a question naming a
+# semester or carrying any number goes to the LLM instead of the table
+_SEMESTER_WORDS = {"semester", "semesters", "sem", "sems"}
+
+
+# Status bands per role, the same thresholds the personas give the LLM:
+# (below this percentage, label), the last band catching everything else.
+# Faculty attendance is professional compliance, not academic risk, so
+# their table has no Status column.
+_ATTENDANCE_BANDS = {
+    "student": [(75, "AT RISK"), (85, "CAUTION"), (None, "SAFE")],
+    "parent":  [(75, "CRITICAL"), (85, "CONCERN"), (None, "GOOD")],
+}
+
+
+def _attendance_status(pct: str, bands: list) -> str:
+    try:
+        value = float(pct)
+    except ValueError:
+        return "?"
+    return next(label for below, label in bands if below is None or value < below)
+
+
+def _attendance_table(text: str, role: str = "student") -> str | None:
+    """Markdown table from the serialised attendance section, or None if it has another shape."""
+    lines = text.splitlines()
+    if len(lines) < 2 or not lines[0].startswith("Semester "):
+        return None
+    bands   = _ATTENDANCE_BANDS.get(role)
+    rows    = []
+    limits  = {label: below for below, label in (bands or [])[:-1]}   # bands worth flagging under the table
+    flagged = {label: [] for label in limits}
+    for line in lines[1:]:
+        cells = line.split(" | ")
+        if len(cells) != 3:
+            return None
+        pct = cells[2] + ("%" if cells[2].replace(".", "", 1).isdigit() else "")
+        if not bands:
+            rows.append(f"| {cells[0]} | {cells[1]} | {pct} |")
+            continue
+        status = _attendance_status(cells[2], bands)
+        if status in flagged:
+            flagged[status].append(cells[0])
+        rows.append(f"| {cells[0]} | {cells[1]} | {pct} | {status} |")
+    notes = "".join(
+        f"\n\n**{label} (below {limits[label]}%):** {', '.join(names)}" for label, names in flagged.items() if names
+    )
+    header = (
+        "| Course | Attended / Total | Percentage | Status |\n|---|---|---|---|\n" if bands else
+        "| Course | Attended / Total | Percentage |\n|---|---|---|\n"
+    )
+    return f"**Attendance — {lines[0]}**\n\n" + header + "\n".join(rows) + notes
+
+
+def direct_answer(context: dict, user_msg: str) -> str | None:
+    """
+    A reply computed without the LLM from a prepare_context() result, or
+    None: the attendance table for pure data requests, else the matching
+    knowledge passage for impersonal questions retrieval answers outright.
+    """
+    if not DIRECT_ANSWERS:
+        return None
+    tokens   = set(_tokenise(user_msg))
+    words    = set(_words(user_msg))   # unlike _tokenise, keeps one-digit semester numbers
+    specific = words & _SEMESTER_WORDS or any(c.isdigit() for word in words for c in word)
+    if "attendance" in tokens and tokens <= _TABLE_WORDS and not specific:
+        table = _attendance_table(context["sections"].get("attendance", ""), context.get("role"))
+        if table:
+            REPLIES.inc(source="direct")
+            return table
+
+    if _PERSONAL_WORDS & set(re.findall(r"[a-z']+", user_msg.lower())):
+        return None
+    passage = best_passage(user_msg)
+    if passage:
+        REPLIES.inc(source="direct")
+        return f"{passage['text']}\n\n_Source: {passage['source']}_"
+    return None
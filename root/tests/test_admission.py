@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import Admission, Overloaded, PRIORITY_GUEST, PRIORITY_USER
+
+
+async def _until(condition, timeout: float = 1.0) -> None:
+    """Let queued tasks run until `condition()` holds."""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0)
+    await asyncio.wait_for(poll(), timeout)
+
+
+@pytest.mark.asyncio
+async def test_queued_calls_are_admitted_by_priority_then_arrival():
+    gate  = Admission(limit=1)
+    order = []
+    await gate.acquire(PRIORITY_USER)
+
+    async def call(priority: int, name: str):
+        await gate.acquire(priority)
+        order.append((name, priority))
+
+    for name, priority in [("guest1", PRIORITY_GUEST), ("user1", PRIORITY_USER),
+                           ("guest2", PRIORITY_GUEST), ("user2", PRIORITY_USER)]:
+        asyncio.create_task(call(priority, name))
+    await _until(lambda: gate.stats()["queued"] == {PRIORITY_USER: 2, PRIORITY_GUEST: 2})
+
+    held = PRIORITY_USER
+    for admitted in range(1, 5):
+        gate.release(held)
+        await _until(lambda: len(order) == admitted)
+        held = order[-1][1]
+    assert [name for name, _ in order] == ["user1", "user2", "guest1", "guest2"]
+
+
+@pytest.mark.asyncio
+async def test_guests_leave_room_for_users():
+    gate = Admission(limit=4)   # guests may hold 3 of the 4 slots
+    for _ in range(3):
+        await gate.acquire(PRIORITY_GUEST)
+
+    waiting = asyncio.create_task(gate.acquire(PRIORITY_GUEST))
+    await _until(lambda: gate.stats()["queued"][PRIORITY_GUEST] == 1)
+    await asyncio.wait_for(gate.acquire(PRIORITY_USER), 0.1)
+    assert not waiting.done()
+
+    gate.release(PRIORITY_USER)
+    await asyncio.sleep(0)
+    assert not waiting.done()   # a user slot freeing up does not lift the guest cap
+    gate.release(PRIORITY_GUEST)
+    await asyncio.wait_for(waiting, 0.1)
+    assert gate.stats()["in_flight"] == {PRIORITY_USER: 0, PRIORITY_GUEST: 3}
+
+
+@pytest.mark.asyncio
+async def test_full_queue_sheds_at_once(monkeypatch):
+    monkeypatch.setitem(admission.MAX_QUEUED, PRIORITY_GUEST, 1)
+    gate = Admission(limit=1)
+    await gate.acquire(PRIORITY_USER)
+    queued = asyncio.create_task(gate.acquire(PRIORITY_GUEST))
+    await _until(lambda: gate.stats()["queued"][PRIORITY_GUEST] == 1)
+
+    with pytest.raises(Overloaded):
+        await gate.acquire(PRIORITY_GUEST)
+    assert gate.shed == 1
+
+    gate.release(PRIORITY_USER)
+    await asyncio.wait_for(queued, 0.1)
+
+
+@pytest.mark.asyncio
+async def test_call_queued_past_the_wait_is_shed(monkeypatch):
+    monkeypatch.setattr(admission, "QUEUE_WAIT", 0.05)
+    gate = Admission(limit=1)
+    await gate.acquire(PRIORITY_USER)
+
+    with pytest.raises(Overloaded):
+        await gate.acquire(PRIORITY_USER)
+    assert gate.shed == 1
+    assert gate.stats()["queued"] == {PRIORITY_USER: 0, PRIORITY_GUEST: 0}
+
+    gate.release(PRIORITY_USER)
+    await asyncio.wait_for(gate.acquire(PRIORITY_USER), 0.1)   # the shed call left no slot behind
+    assert gate.stats()["in_flight"][PRIORITY_USER] == 1
@@ -0,0 +1,69 @@
+import time
+
+from cache import MemoryCache
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = MemoryCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1   # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_total_bytes_stay_under_the_bound():
+    cache = MemoryCache(max_bytes=100)
+    for key in "abcd":
+        cache.set(key, "x" * 40)
+    assert cache.stats()["bytes"] <= 100
+    assert [cache.get(key) is not None for key in "abcd"] == [False, False, True, True]
+
+
+def test_replacing_a_value_counts_its_bytes_once():
+    cache = MemoryCache(max_bytes=100)
+    for _ in range(5):
+        cache.set("a", "x" * 60)
+    assert cache.stats()["bytes"] == 60
+    assert cache.evictions == 0
+
+
+def test_oversized_value_removes_the_old_one():
+    cache = MemoryCache(max_bytes=100)
+    cache.set("a", "old")
+    cache.set("a", "x" * 200)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_entries_expire_after_their_ttl():
+    cache = MemoryCache(ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.expirations == 1
+
+
+def test_purge_drops_expired_entries_and_their_bytes():
+    cache = MemoryCache(ttl=0.05)
+    cache.set("a", "x" * 10)
+    cache.set("b", "x" * 10, ttl=60)
+    time.sleep(0.06)
+    assert cache.purge_expired() == 1
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 10
+    assert [key for key, _ in cache.items()] == ["b"]
+
+
+def test_add_sets_only_absent_or_expired_keys():
+    cache = MemoryCache(ttl=0.05)
+    assert cache.add("lease", "worker-1")
+    assert not cache.add("lease", "worker-2")
+    time.sleep(0.06)
+    assert cache.add("lease", "worker-2")
+    assert cache.get("lease") == "worker-2"
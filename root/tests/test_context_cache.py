@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import ai_handler
+import key_scheduler
+from bench.fakes import FakeGemini
+from cache import MemoryCache
+
+PREFIX = "You are the PESU assistant. " * 400   # above the context cache minimum
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """One fake Gemini key with budgets high enough never to block."""
+    client = FakeGemini(latency=0.01)
+    monkeypatch.setattr(key_scheduler, "KEY_RPM", 10**6)
+    monkeypatch.setattr(key_scheduler, "KEY_TPM", 10**9)
+    monkeypatch.setattr(key_scheduler, "KEY_RPD", 10**7)
+    monkeypatch.setattr(ai_handler, "_clients", [client])
+    monkeypatch.setattr(ai_handler, "_scheduler", key_scheduler.KeyScheduler([client]))
+    monkeypatch.setattr(ai_handler, "_context_caches", {})
+    monkeypatch.setattr(ai_handler, "_cache", MemoryCache(ttl=ai_handler.CACHE_TTL))
+    monkeypatch.setattr(ai_handler, "CONTEXT_CACHE", True)
+    return client
+
+
+def _prompt(n: int) -> dict:
+    return {"text": f"{PREFIX}question {n}", "prefix": PREFIX, "rest": f"question {n}"}
+
+
+async def _settle() -> None:
+    while ai_handler._background:
+        await asyncio.gather(*ai_handler._background)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_first_calls_create_one_context_cache(gemini):
+    await asyncio.gather(*(ai_handler.ask_ai(_prompt(n)) for n in range(6)))
+    await _settle()
+    assert gemini.caches.created == 1
+    assert len(gemini.caches.store) == 1
+
+
+@pytest.mark.asyncio
+async def test_calls_after_creation_use_the_cache(gemini):
+    await ai_handler.ask_ai(_prompt(0))
+    await _settle()
+    await ai_handler.ask_ai(_prompt(1))
+    assert gemini.cached_calls == 1
+
+    await ai_handler.close_context_caches()
+    assert gemini.caches.deleted == 1
+    assert not gemini.caches.store
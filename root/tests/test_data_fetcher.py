@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import data_fetcher
+from bench.fakes import FakePESUAcademy
+from cache import MemoryCache
+
+
+@pytest.fixture(autouse=True)
+def portal(monkeypatch):
+    """A fake portal and empty per-user state for every test."""
+    FakePESUAcademy.configure(latency=0.01)
+    monkeypatch.setattr(data_fetcher, "PESUAcademy", FakePESUAcademy)
+    monkeypatch.setattr(data_fetcher, "_upstream", asyncio.Semaphore(data_fetcher.MAX_UPSTREAM))
+    monkeypatch.setattr(data_fetcher, "_user_state", MemoryCache(ttl=data_fetcher.STATE_IDLE_TTL))
+    monkeypatch.setattr(data_fetcher, "_clients", {})
+    monkeypatch.setattr(data_fetcher, "_inflight", {})
+    monkeypatch.setattr(data_fetcher, "_failures", {})
+    monkeypatch.setattr(data_fetcher, "_public_client", None)
+    return FakePESUAcademy
+
+
+@pytest.mark.asyncio
+async def test_concurrent_fetches_for_a_user_share_one_portal_fetch(portal):
+    results = await asyncio.gather(*(
+        data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "student", refresh_all=True) for _ in range(10)
+    ))
+    assert portal.logins == 1
+    assert portal.calls == 2 + 3   # login (CSRF + POST), then profile, timetable and every semester
+    assert all(result is results[0] for result in results)
+    assert not data_fetcher._inflight
+
+
+@pytest.mark.asyncio
+async def test_fetches_for_different_users_are_not_shared(portal):
+    first, second = await asyncio.gather(
+        data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "student"),
+        data_fetcher.fetch_user_data("PES1UG23CS002", "pw", "student"),
+    )
+    assert portal.logins == 2
+    assert first["username"] != second["username"]
+
+
+@pytest.mark.asyncio
+async def test_a_failure_is_replayed_without_calling_the_portal(portal):
+    with pytest.raises(Exception, match="Invalid credentials") as first:
+        await data_fetcher.fetch_user_data("PES1UG23CS001", "wrong", "student")
+    with pytest.raises(Exception) as again:
+        await data_fetcher.fetch_user_data("PES1UG23CS001", "wrong", "student")
+    assert again.value is first.value
+    assert portal.logins == 1
+
+
+@pytest.mark.asyncio
+async def test_a_failure_is_retried_once_it_expires(portal, monkeypatch):
+    with pytest.raises(Exception):
+        await data_fetcher.fetch_user_data("PES1UG23CS001", "wrong", "student")
+    monkeypatch.setattr(data_fetcher, "FAILURE_TTL", 0)
+    with pytest.raises(Exception):
+        await data_fetcher.fetch_user_data("PES1UG23CS001", "wrong", "student")
+    assert portal.logins == 2
+
+
+@pytest.mark.asyncio
+async def test_a_cancelled_caller_does_not_cancel_the_shared_fetch(portal):
+    fetch = lambda: data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "student")
+    impatient = asyncio.create_task(fetch())
+    patient   = asyncio.create_task(fetch())
+    await asyncio.sleep(0)
+    impatient.cancel()
+
+    data = await patient
+    assert data["username"] == "PES1UG23CS001"
+    assert portal.logins == 1
+
+
+@pytest.mark.asyncio
+async def test_a_faculty_fetch_includes_section_info(portal):
+    data = await data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "faculty", refresh_all=True)
+    assert data["role"] == "faculty"
+    assert data["section_info"]["students"] == 64
+    assert data["section_info"]["section"] == data["profile"]["section"]
+
+
+@pytest.mark.asyncio
+async def test_a_refresh_within_the_ttls_does_not_call_the_portal(portal):
+    first = await data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "faculty", refresh_all=True)
+    calls = portal.calls
+    again = await data_fetcher._refresh("faculty", "PES1UG23CS001", "pw", refresh_all=False)
+    assert portal.calls == calls
+    assert again["version"] == first["version"]
+    assert again["section_info"] == first["section_info"]
+
+
+@pytest.mark.asyncio
+async def test_only_lapsed_sections_are_refetched(portal, monkeypatch):
+    await data_fetcher.fetch_user_data("PES1UG23CS001", "pw", "student", refresh_all=True)
+    monkeypatch.setitem(data_fetcher.SECTION_TTLS, "attendance", 0)
+    calls = portal.calls
+    await data_fetcher._refresh("student", "PES1UG23CS001", "pw", refresh_all=False)
+    assert portal.calls == calls + 1   # the current semester only, on the pooled client
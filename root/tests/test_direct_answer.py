@@ -0,0 +1,94 @@
+import pytest
+
+import rag
+import security
+from security import direct_answer
+
+ATTENDANCE = "Semester 6\nMaths | 30/40 | 75.0\nPhysics | 20/40 | 50.0\nChemistry | 38/40 | 95.0"
+
+KNOWLEDGE = {
+    "hostel.txt": (
+        "Hostel curfew is at 9:30 PM every night for all residents.\n"
+        "Visitors may meet residents only in the lobby.\n"
+    ),
+    "library.txt": (
+        "The central library opens at 8 AM and closes at 10 PM.\n"
+        "Books can be borrowed for fourteen days with a student ID card.\n"
+    ),
+    "exams.txt": (
+        "Students need 75 percent attendance to sit the end semester exam.\n"
+        "Revaluation requests are filed on the portal within a week of results.\n"
+    ),
+}
+
+
+@pytest.fixture(autouse=True)
+def knowledge(tmp_path):
+    """A small knowledge base in place of knowledge/ for every test."""
+    saved = rag.KNOWLEDGE_DIR, rag.INDEX_DIR
+    rag.KNOWLEDGE_DIR = tmp_path / "knowledge"
+    rag.KNOWLEDGE_DIR.mkdir()
+    for name, text in KNOWLEDGE.items():
+        (rag.KNOWLEDGE_DIR / name).write_text(text, encoding="utf-8")
+    rag._use_index_dir(rag.KNOWLEDGE_DIR / ".index")
+    rag.load_knowledge()
+    yield
+    rag.KNOWLEDGE_DIR = saved[0]
+    rag._use_index_dir(saved[1])
+    rag.load_knowledge()
+
+
+def _context(role: str = "student") -> dict:
+    return {"role": role, "sections": {"attendance": ATTENDANCE}}
+
+
+@pytest.mark.parametrize("question", ["show my attendance", "what is my attendance", "attendance percentage please"])
+def test_a_plain_attendance_request_gets_the_table(question):
+    reply = direct_answer(_context(), question)
+    assert reply.startswith("**Attendance — Semester 6**")
+    assert "| Physics | 20/40 | 50.0% | AT RISK |" in reply
+    assert "**AT RISK (below 75%):** Physics" in reply
+
+
+@pytest.mark.parametrize("question", [
+    "show my attendance for semester 2", "attendance sem 3", "my attendance for semester 10",
+    "attendance in 2nd sem", "show my attendance this semester",
+])
+def test_a_question_about_a_given_semester_goes_to_the_llm(question):
+    assert direct_answer(_context(), question) is None
+
+
+def test_faculty_attendance_has_no_status_column():
+    reply = direct_answer(_context("faculty"), "show my attendance")
+    assert "| Course | Attended / Total | Percentage |\n" in reply
+    assert "| Physics | 20/40 | 50.0% |\n" in reply
+    assert "Status" not in reply and "below 75%" not in reply
+
+
+def test_a_parent_gets_the_parent_bands():
+    reply = direct_answer(_context("parent"), "show attendance")
+    assert "| Physics | 20/40 | 50.0% | CRITICAL |" in reply
+    assert "| Chemistry | 38/40 | 95.0% | GOOD |" in reply
+
+
+def test_an_impersonal_faq_is_answered_from_its_passage():
+    reply = direct_answer(_context(), "what is the hostel curfew")
+    assert reply == "Hostel curfew is at 9:30 PM every night for all residents.\n\n_Source: Hostel_"
+
+
+@pytest.mark.parametrize("question", ["is the hostel curfew not at 9:30", "why is there no hostel curfew"])
+def test_a_negated_faq_goes_to_the_llm(question):
+    assert rag.best_passage(question) is None
+    assert direct_answer(_context(), question) is None
+
+
+@pytest.mark.parametrize("question", ["hostel curfew for me", "what is the hostel curfew i have"])
+def test_a_personal_question_goes_to_the_llm(question):
+    assert rag.best_passage(question) is not None   # retrieval alone would answer it
+    assert direct_answer(_context(), question) is None
+
+
+def test_direct_answers_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(security, "DIRECT_ANSWERS", False)
+    assert direct_answer(_context(), "show my attendance") is None
+    assert direct_answer(_context(), "what is the hostel curfew") is None
@@ -0,0 +1,55 @@
+import gzip
+
+from starlette.requests import Request
+
+import payload
+from main import _json_response
+
+SMALL = payload.encode({"hello": "world"})
+LARGE = payload.encode({"rows": ["attendance row"] * 200})
+
+
+def _request(**headers) -> Request:
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "headers": raw})
+
+
+def test_a_body_is_served_with_its_etag():
+    response = _json_response(_request(), SMALL)
+    assert response.status_code == 200
+    assert response.body == SMALL["body"]
+    assert response.headers["etag"] == SMALL["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+
+def test_a_matching_if_none_match_gets_a_304():
+    response = _json_response(_request(if_none_match=SMALL["etag"]), SMALL)
+    assert response.status_code == 304
+    assert not response.body
+
+
+def test_a_stale_etag_gets_the_body():
+    response = _json_response(_request(if_none_match='"0000", ' + LARGE["etag"]), SMALL)
+    assert response.status_code == 200
+    assert response.body == SMALL["body"]
+
+
+def test_gzip_has_its_own_tag_and_revalidates_against_the_body():
+    response = _json_response(_request(accept_encoding="gzip, br"), LARGE)
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(response.body) == LARGE["body"]
+    gz_tag = response.headers["etag"]
+    assert gz_tag != LARGE["etag"] and gz_tag.endswith('-gz"')
+
+    # browsers send the tag they were given, weakened by some proxies
+    for tag in (gz_tag, "W/" + gz_tag, "*"):
+        again = _json_response(_request(accept_encoding="gzip", if_none_match=tag), LARGE)
+        assert again.status_code == 304
+        assert again.headers["etag"] == gz_tag
+
+
+def test_per_request_fields_skip_the_etag():
+    response = _json_response(_request(if_none_match=SMALL["etag"]), SMALL, token="abc")
+    assert response.status_code == 200
+    assert "etag" not in response.headers
+    assert payload.loads(response.body) == {"token": "abc", "hello": "world"}
@@ -0,0 +1,87 @@
+import types
+
+import pytest
+
+import key_scheduler
+from key_scheduler import KeyScheduler, retry_after
+
+
+def _rate_limited(delay: str) -> Exception:
+    return Exception(
+        "429 RESOURCE_EXHAUSTED. {'error': {'code': 429, 'details': "
+        f"[{{'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '{delay}'}}]}}}}"
+    )
+
+
+def _blocked_for(scheduler: KeyScheduler) -> list[float]:
+    return [key["blocked_for"] for key in scheduler.stats()]
+
+
+def test_retry_after_reads_the_header_and_the_error_body():
+    header = Exception("429 Too Many Requests")
+    header.response = types.SimpleNamespace(headers={"retry-after": "12"})
+    assert retry_after(header) == 12.0
+    assert retry_after(_rate_limited("37s")) == 37.0
+    assert retry_after(Exception("Quota exceeded. Please retry in 4.5s.")) == 4.5
+    assert retry_after(Exception("500 INTERNAL")) is None
+
+
+@pytest.mark.asyncio
+async def test_calls_spread_across_keys_by_headroom():
+    scheduler = KeyScheduler(["a", "b"])
+    first  = await scheduler.acquire(100)
+    second = await scheduler.acquire(100)
+    assert {first.client, second.client} == {"a", "b"}
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_quarantines_a_key_for_the_retry_hint():
+    scheduler = KeyScheduler(["a", "b"])
+    lease = await scheduler.acquire(100)
+    lease.failed(_rate_limited("30s"))
+
+    blocked = _blocked_for(scheduler)
+    assert 29 <= blocked[lease.key.index] <= 30
+    for _ in range(3):
+        assert (await scheduler.acquire(100)).key is not lease.key
+
+
+@pytest.mark.asyncio
+async def test_failures_back_off_exponentially_until_a_success():
+    scheduler = KeyScheduler(["a"])
+    key = scheduler._keys[0]
+    for expected in (2, 4, 8):
+        key.blocked_until = 0.0
+        (await scheduler.acquire(100)).failed(ConnectionError("reset"))
+        assert _blocked_for(scheduler)[0] == pytest.approx(expected, abs=0.2)
+
+    key.blocked_until = 0.0
+    (await scheduler.acquire(100)).ok(150)
+    assert key.strikes == 0
+
+
+@pytest.mark.asyncio
+async def test_bad_requests_do_not_quarantine_the_key():
+    scheduler = KeyScheduler(["a"])
+    (await scheduler.acquire(100)).failed(Exception("400 INVALID_ARGUMENT. Cached content is too small"))
+    (await scheduler.acquire(100)).failed(Exception("404 NOT_FOUND. CachedContent not found"))
+    assert _blocked_for(scheduler) == [0.0]
+
+
+@pytest.mark.asyncio
+async def test_acquire_gives_up_when_no_key_frees_up_in_time(monkeypatch):
+    monkeypatch.setattr(key_scheduler, "MAX_WAIT", 0.1)
+    scheduler = KeyScheduler(["a", "b"])
+    for _ in range(2):
+        (await scheduler.acquire(100)).failed(_rate_limited("60s"))
+    assert await scheduler.acquire(100) is None
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_a_short_quarantine(monkeypatch):
+    monkeypatch.setattr(key_scheduler, "MAX_WAIT", 1.0)
+    scheduler = KeyScheduler(["a"])
+    lease = await scheduler.acquire(100)
+    lease.failed(Exception("503 UNAVAILABLE"))
+    scheduler._keys[0].blocked_until -= 1.8   # 0.2s of the 2s backoff left
+    assert (await scheduler.acquire(100)).key is lease.key